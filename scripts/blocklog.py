@@ -7,13 +7,46 @@ Commands
 ^^^^^^^^
 
 * ``/history`` Check block history with left-click. Right-click to check space directly above the block. Follow up clicks show older records
+* ``/blocks <player>`` Total amount of blocks placed by player
+* ``/blockcountsrebuild`` Recount placed and destroyed blocks per player from the whole log *admin only*
+* ``/edits <minutes>`` List edits inside the current creativetools selection grouped by session and time window *admin only*
+* ``/undoedits <player or #session> <time, e.g. 30m/2h/3d>`` Revert blocks changed by a player since given time. Requires rollback.py *admin only*
+* ``/blocklogcompact`` Archive old records, collapse repaints and vacuum blocklog.db now *admin only*
+* ``/blocklogvacuum`` Rebuild blocklog.db with a full VACUUM, once for databases created before incremental vacuum *admin only*
+* ``/blocklogstatus`` Show how far behind the block log writer is *admin only*
+
+Options
+^^^^^^^
+
+.. code-block:: toml
+
+    [blocklog]
+    flush_interval = 180 # seconds between flushes of queued block operations
+    flush_size = 5000 # flush earlier once this many operations are queued
+    history_cache_size = 1024 # number of coordinates with cached history pages
+    storage = "sqlite" # or "segments" to keep records in compact daily segment files
+    compact_interval = 24 # hours between compaction runs, 0 to only run it with /blocklogcompact
+    archive_after_days = 365 # records older than this are moved to blocklog-archive/, 0 to keep everything
+
+Compaction frees space with incremental vacuum, which blocklog.db files created by older versions don't support.
+Run ``/blocklogvacuum`` once for those; block operations are only written again after it finishes.
+Block counts of archived and collapsed records are kept in ``block_counts_archived`` so /blockcountsrebuild still includes them.
+Records logged before /blocks counts existed are counted in the background, in slices, on the first start.
+Missing indexes are built by the writer thread on start, so new block operations on a large log are written after that.
+
+With ``storage = "segments"`` records are written into ``blocklog/`` in the config directory instead of blocklog.db.
+/history and /blocks work the same, /edits and /blockcountsrebuild need the sqlite storage.
 
 .. codeauthor:: Liza
 """
 
 import datetime
-import os, sqlite3
+import csv, gzip, io, mmap, os, queue, sqlite3, struct, threading, time, zlib
+from collections import OrderedDict, deque
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.logger import Logger
 from piqueserver.commands import command, get_player
 from piqueserver.config import config
 from pyspades.bytes import ByteReader
@@ -26,14 +59,590 @@ from pyspades import contained as loaders
 db_path = os.path.join(config.config_dir, 'sqlite.db')
 con = sqlite3.connect(db_path)
 db_path_log = os.path.join(config.config_dir, 'blocklog.db')
+archive_path = os.path.join(config.config_dir, 'blocklog-archive')
 con_log = sqlite3.connect(db_path_log)
 cur_log = con_log.cursor()
+cur_log.execute('PRAGMA auto_vacuum = INCREMENTAL') # only applies to new databases, /blocklogvacuum converts old ones
+cur_log.execute('PRAGMA journal_mode=WAL')
 cur_log.execute('CREATE TABLE IF NOT EXISTS blocklog(id INTEGER PRIMARY KEY, timestamp INTEGER, xyz INTEGER, session INTEGER, action INTEGER, color INTEGER, undone INTEGER)')
+if 'morton' not in [x[1] for x in cur_log.execute('PRAGMA table_info(blocklog)').fetchall()]:
+    cur_log.execute('ALTER TABLE blocklog ADD COLUMN morton INTEGER')
+new_counts = not cur_log.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'block_counts'").fetchone()
+cur_log.execute('CREATE TABLE IF NOT EXISTS block_counts(user TEXT PRIMARY KEY COLLATE NOCASE, placed INTEGER, destroyed INTEGER)')
+cur_log.execute('CREATE TABLE IF NOT EXISTS block_counts_backfill(next_id INTEGER, end_id INTEGER)')
+if new_counts: # records logged before block_counts existed are counted by backfill_block_counts
+    cur_log.execute('INSERT INTO block_counts_backfill SELECT 0, id FROM blocklog ORDER BY id DESC LIMIT 1')
+cur_log.execute('CREATE TABLE IF NOT EXISTS block_counts_archived(user TEXT PRIMARY KEY COLLATE NOCASE, placed INTEGER, destroyed INTEGER)')
 con_log.commit()
 cur_log.close()
 
 results_per_page = 6
 
+blocklog_config = config.section('blocklog')
+FLUSH_INTERVAL_OPTION = blocklog_config.option('flush_interval', 180)
+FLUSH_SIZE_OPTION = blocklog_config.option('flush_size', 5000)
+HISTORY_CACHE_SIZE_OPTION = blocklog_config.option('history_cache_size', 1024)
+STORAGE_OPTION = blocklog_config.option('storage', 'sqlite')
+COMPACT_INTERVAL_OPTION = blocklog_config.option('compact_interval', 24)
+ARCHIVE_AFTER_DAYS_OPTION = blocklog_config.option('archive_after_days', 365)
+
+UNDO_BATCH = 5000 # rows read per query when looking up edits to undo
+ARCHIVE_BATCH = 20000 # rows moved per archive slice
+VACUUM_PAGES = 2000 # pages released per incremental vacuum slice
+
+log = Logger()
+
+SEGMENT_RECORD = struct.Struct('<IIII') # seconds since start of day, xyz, session, color | action << 24 | undone << 25
+SEGMENT_INDEX = struct.Struct('<II') # xyz, record number
+SEGMENT_HEADER = struct.Struct('<II') # number of records, number of chunks
+SEGMENT_OFFSET = struct.Struct('<Q')
+SEGMENT_CHUNK = 4096 # records per compressed chunk of a sealed segment
+SEGMENT_CHUNK_CACHE = 64
+
+
+class SegmentStore:
+    """
+    Block log kept in one file per UTC day. The current day is appended as raw records, older days are sealed into
+    zlib-compressed chunks (.segz) and an index of records sorted by xyz (.idx), both read through mmap.
+    Record IDs are day << 32 | record number
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.day = None
+        self.active = None
+        self.active_count = 0
+        self.active_index = {} # xyz: [record numbers] of the current day
+        self.sealed = {} # day: (index mmap, data mmap)
+        self.chunks = OrderedDict() # (day, chunk): decompressed records
+        today = int(time.time()) // 86400
+        for name in os.listdir(path):
+            day, ext = os.path.splitext(name)
+            if ext == '.seg' and int(day) < today:
+                self.seal(int(day))
+        for name in os.listdir(path):
+            day, ext = os.path.splitext(name)
+            if ext == '.idx':
+                self.open_sealed(int(day))
+        if os.path.exists(self.file(today, '.seg')):
+            self.open_active(today)
+
+    def file(self, day, ext):
+        return os.path.join(self.path, '%s%s' % (day, ext))
+
+    def append(self, rows):
+        with self.lock:
+            for timestamp, xyz, session, action, color, undone in rows:
+                day = timestamp // 86400
+                if self.day is None or day > self.day:
+                    self.open_active(day)
+                self.active.write(SEGMENT_RECORD.pack(max(timestamp - self.day * 86400, 0), xyz, session or 0,
+                                                      color | bool(action) << 24 | bool(undone) << 25))
+                self.active_index.setdefault(xyz, []).append(self.active_count)
+                self.active_count += 1
+            if self.active:
+                self.active.flush()
+
+    def open_active(self, day):
+        if self.active:
+            self.active.close()
+            self.seal(self.day)
+            self.open_sealed(self.day)
+        self.day = day
+        self.active = open(self.file(day, '.seg'), 'ab+')
+        self.active.seek(0)
+        data = self.active.read()
+        self.active_count = len(data) // SEGMENT_RECORD.size
+        self.active_index = {}
+        for n in range(self.active_count):
+            self.active_index.setdefault(SEGMENT_RECORD.unpack_from(data, n * SEGMENT_RECORD.size)[1], []).append(n)
+
+    def seal(self, day):
+        with open(self.file(day, '.seg'), 'rb') as f:
+            data = f.read()
+        count = len(data) // SEGMENT_RECORD.size
+        index = sorted((SEGMENT_RECORD.unpack_from(data, n * SEGMENT_RECORD.size)[1], n) for n in range(count))
+        chunk_size = SEGMENT_CHUNK * SEGMENT_RECORD.size
+        chunks = [zlib.compress(data[i:i + chunk_size]) for i in range(0, count * SEGMENT_RECORD.size, chunk_size)]
+        with open(self.file(day, '.segz.tmp'), 'wb') as f:
+            f.write(b''.join(chunks))
+        with open(self.file(day, '.idx.tmp'), 'wb') as f:
+            f.write(SEGMENT_HEADER.pack(count, len(chunks)))
+            offset = 0
+            for chunk in chunks:
+                f.write(SEGMENT_OFFSET.pack(offset))
+                offset += len(chunk)
+            f.write(SEGMENT_OFFSET.pack(offset))
+            f.write(b''.join(SEGMENT_INDEX.pack(*x) for x in index))
+        os.replace(self.file(day, '.segz.tmp'), self.file(day, '.segz'))
+        os.replace(self.file(day, '.idx.tmp'), self.file(day, '.idx'))
+        os.remove(self.file(day, '.seg'))
+
+    def open_sealed(self, day):
+        maps = []
+        for ext in ('.idx', '.segz'):
+            with open(self.file(day, ext), 'rb') as f:
+                maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b'')
+        self.sealed[day] = tuple(maps)
+
+    def sealed_records(self, day, xyz):
+        index, data = self.sealed[day]
+        count, chunks = SEGMENT_HEADER.unpack_from(index, 0)
+        start = SEGMENT_HEADER.size + (chunks + 1) * SEGMENT_OFFSET.size
+        # binary search for the first index entry of xyz
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if SEGMENT_INDEX.unpack_from(index, start + mid * SEGMENT_INDEX.size)[0] < xyz:
+                low = mid + 1
+            else:
+                high = mid
+        numbers = []
+        while low < count:
+            entry_xyz, n = SEGMENT_INDEX.unpack_from(index, start + low * SEGMENT_INDEX.size)
+            if entry_xyz != xyz:
+                break
+            numbers.append(n)
+            low += 1
+        return numbers
+
+    def sealed_record(self, day, n):
+        key = (day, n // SEGMENT_CHUNK)
+        if key not in self.chunks:
+            index, data = self.sealed[day]
+            begin, end = struct.unpack_from('<QQ', index, SEGMENT_HEADER.size + key[1] * SEGMENT_OFFSET.size)
+            self.chunks[key] = zlib.decompress(data[begin:end])
+            while len(self.chunks) > SEGMENT_CHUNK_CACHE:
+                self.chunks.popitem(last=False)
+        self.chunks.move_to_end(key)
+        return SEGMENT_RECORD.unpack_from(self.chunks[key], (n % SEGMENT_CHUNK) * SEGMENT_RECORD.size)
+
+    def active_record(self, n):
+        return SEGMENT_RECORD.unpack(os.pread(self.active.fileno(), SEGMENT_RECORD.size, n * SEGMENT_RECORD.size))
+
+    def history(self, xyz, offset, limit):
+        """
+        Same rows as the blocklog table query: (id, timestamp, xyz, session, action, color, undone), newest first
+        """
+        rows = []
+        with self.lock:
+            days = sorted(list(self.sealed) + ([self.day] if self.active else []), reverse=True)
+            for day in days:
+                if day == self.day and self.active:
+                    numbers, read = self.active_index.get(xyz, []), self.active_record
+                else:
+                    numbers, read = self.sealed_records(day, xyz), lambda n, day=day: self.sealed_record(day, n)
+                for n in reversed(numbers):
+                    if offset:
+                        offset -= 1
+                        continue
+                    delta, record_xyz, session, value = read(n)
+                    rows.append((day << 32 | n, day * 86400 + delta, record_xyz, session,
+                                 value >> 24 & 1, value & 0xFFFFFF, value >> 25 & 1))
+                    if len(rows) >= limit:
+                        return rows
+        return rows
+
+segment_store = SegmentStore(os.path.join(config.config_dir, 'blocklog')) if STORAGE_OPTION.get() == 'segments' else None
+
+
+class HistoryCache:
+    """
+    LRU of history pages per coordinate. Pages of a coordinate are dropped once new records for it are written
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict() # xyz: {(offset, limit): rows}
+
+    def get(self, xyz, offset, limit):
+        if xyz in self.pages:
+            self.pages.move_to_end(xyz)
+            return self.pages[xyz].get((offset, limit))
+
+    def put(self, xyz, offset, limit, rows):
+        self.pages.setdefault(xyz, {})[(offset, limit)] = rows
+        self.pages.move_to_end(xyz)
+        while len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+
+    def invalidate(self, xyzs):
+        for xyz in xyzs:
+            self.pages.pop(xyz, None)
+
+MORTON_SPREAD = [sum(((v >> i) & 1) << (3 * i) for i in range(9)) for v in range(512)]
+MORTON_BACKFILL_ROWS = 50000
+COUNTS_BACKFILL_IDS = 50000 # record ids counted per block_counts backfill slice
+
+def morton(xyz):
+    """
+    Z-order key of a packed xyz, so that boxes map to a few contiguous key ranges
+    """
+    return MORTON_SPREAD[(xyz >> 15) & 511] << 2 | MORTON_SPREAD[(xyz >> 6) & 511] << 1 | MORTON_SPREAD[xyz & 63]
+
+def morton_ranges(x1, y1, z1, x2, y2, z2, min_size=8):
+    """
+    Split a box (inclusive corners) into ranges of morton keys. Octree nodes smaller than min_size are taken whole,
+    so ranges may cover a few blocks outside the box
+    """
+    ranges = []
+    def visit(x, y, z, size):
+        if x > x2 or y > y2 or z > z2 or x + size <= x1 or y + size <= y1 or z + size <= z1:
+            return
+        inside = x >= x1 and y >= y1 and z >= z1 and x + size - 1 <= x2 and y + size - 1 <= y2 and z + size - 1 <= z2
+        if inside or size <= min_size:
+            code = MORTON_SPREAD[x] << 2 | MORTON_SPREAD[y] << 1 | MORTON_SPREAD[z]
+            if ranges and ranges[-1][1] + 1 == code:
+                ranges[-1][1] = code + size ** 3 - 1
+            else:
+                ranges.append([code, code + size ** 3 - 1])
+            return
+        half = size // 2
+        for child in range(8):
+            visit(x + (child >> 2 & 1) * half, y + (child >> 1 & 1) * half, z + (child & 1) * half, half)
+    visit(0, 0, 0, 512)
+    return ranges
+
+def create_indexes(con):
+    """
+    Build missing blocklog indexes. Runs first on the writer thread, since indexing an existing log takes a while
+    """
+    con.execute('CREATE INDEX IF NOT EXISTS blocklog_xyz ON blocklog(xyz, id)')
+    con.execute('CREATE INDEX IF NOT EXISTS blocklog_session ON blocklog(session, id)')
+    con.execute('CREATE INDEX IF NOT EXISTS blocklog_morton ON blocklog(morton)')
+    con.commit()
+
+def backfill_morton(con):
+    con.create_function('morton', 1, morton)
+    cur = con.execute('UPDATE blocklog SET morton = morton(xyz) WHERE id IN (SELECT id FROM blocklog WHERE morton IS NULL LIMIT ?)', (MORTON_BACKFILL_ROWS,))
+    con.commit()
+    return cur.rowcount
+
+def database_size(con):
+    return con.execute('PRAGMA page_count').fetchone()[0] * con.execute('PRAGMA page_size').fetchone()[0]
+
+def compact_prepare(con):
+    # databases created before incremental vacuum was enabled keep their free pages until /blocklogvacuum
+    return database_size(con), con.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+def add_block_counts(con, table, where, args):
+    """
+    Add the block counts of records matching where to table (block_counts or block_counts_archived).
+    sessions.db must be attached as sessions_db
+    """
+    con.execute('INSERT INTO %s(user, placed, destroyed) '
+                'SELECT s.user, SUM(b.action = 1), SUM(b.action = 0) FROM blocklog b JOIN sessions_db.sessions s ON s.id = b.session '
+                'WHERE %s GROUP BY s.user COLLATE NOCASE '
+                'ON CONFLICT(user) DO UPDATE SET placed = placed + excluded.placed, destroyed = destroyed + excluded.destroyed' % (table, where),
+                args)
+
+def backfill_block_counts(con):
+    """
+    Count the next slice of records logged before block_counts existed. Returns True while there are more
+    """
+    row = con.execute('SELECT next_id, end_id FROM block_counts_backfill').fetchone()
+    if row is None:
+        return False
+    next_id, end_id = row
+    last_id = min(next_id + COUNTS_BACKFILL_IDS, end_id) # later records were counted when they were written
+    con.execute('ATTACH DATABASE ? AS sessions_db', (db_path,))
+    try:
+        add_block_counts(con, 'block_counts', 'b.id > ? AND b.id <= ?', (next_id, last_id))
+        if last_id < end_id:
+            con.execute('UPDATE block_counts_backfill SET next_id = ?', (last_id,))
+        else:
+            con.execute('DELETE FROM block_counts_backfill')
+        con.commit()
+    finally:
+        con.rollback()
+        con.execute('DETACH DATABASE sessions_db')
+    return last_id < end_id
+
+def compact_archive(con, cutoff):
+    rows = con.execute('SELECT id, timestamp, xyz, session, action, color, undone FROM blocklog WHERE timestamp < ? ORDER BY id LIMIT ?',
+                       (cutoff, ARCHIVE_BATCH)).fetchall()
+    if rows:
+        os.makedirs(archive_path, exist_ok=True)
+        with gzip.open(os.path.join(archive_path, '%s.csv.gz' % time.strftime('%Y-%m-%d')), 'at', newline='') as f:
+            csv.writer(f).writerows(rows)
+        con.execute('ATTACH DATABASE ? AS sessions_db', (db_path,))
+        try:
+            add_block_counts(con, 'block_counts_archived', 'b.timestamp < ? AND b.id <= ?', (cutoff, rows[-1][0]))
+            con.executemany('DELETE FROM blocklog WHERE id = ?', ((x[0],) for x in rows))
+            con.commit()
+        finally:
+            con.rollback() # DETACH fails inside a transaction
+            con.execute('DETACH DATABASE sessions_db')
+    return len(rows)
+
+# builds within a range of xyz that the same session replaced with another build of the same block right after
+COLLAPSE_IDS = '''SELECT id FROM (
+    SELECT id, session, action, undone,
+        LEAD(session) OVER w AS next_session, LEAD(action) OVER w AS next_action, LEAD(undone) OVER w AS next_undone
+    FROM blocklog WHERE xyz BETWEEN ? AND ? WINDOW w AS (PARTITION BY xyz ORDER BY id))
+WHERE action = 1 AND next_action = 1 AND session = next_session AND NOT undone AND NOT next_undone'''
+
+def compact_collapse(con, x):
+    """
+    Within map column x, drop builds that the same session replaced with another build of the same block right after
+    """
+    args = (x << 15, (x + 1 << 15) - 1)
+    con.execute('ATTACH DATABASE ? AS sessions_db', (db_path,))
+    try:
+        add_block_counts(con, 'block_counts_archived', 'b.id IN (%s)' % COLLAPSE_IDS, args)
+        cur = con.execute('DELETE FROM blocklog WHERE id IN (%s)' % COLLAPSE_IDS, args)
+        con.commit()
+    finally:
+        con.rollback()
+        con.execute('DETACH DATABASE sessions_db')
+    return cur.rowcount
+
+def compact_vacuum(con):
+    con.executescript('PRAGMA incremental_vacuum(%d);' % VACUUM_PAGES) # execute() would only step once and free a single page
+    return con.execute('PRAGMA freelist_count').fetchone()[0], database_size(con)
+
+def full_vacuum(con):
+    start = time.monotonic()
+    con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    con.execute('VACUUM')
+    return time.monotonic() - start
+
+def parse_duration(value):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value) * 3600
+
+def plan_undo(con, player, session, since):
+    """
+    Find blocks to restore after undoing edits of a player, or of one session if player is None. Returns [(xyz, color)]
+    where color is None for empty space and False when the block has no older history (original map state), and ids of
+    the undone records per xyz
+    """
+    if player is None:
+        match, match_args = 'session = ?', [session]
+    else: # sessions are looked up by the query rather than bound one by one
+        con.execute('ATTACH DATABASE ? AS sessions_db', (db_path,))
+        match, match_args = 'session IN (SELECT id FROM sessions_db.sessions WHERE user = ?)', [player]
+    try:
+        return plan_undo_matching(con, match, match_args, since)
+    finally:
+        if player is not None:
+            con.execute('DETACH DATABASE sessions_db')
+
+def plan_undo_matching(con, match, match_args, since):
+    first = {} # xyz: (id, action, color) of the earliest matching edit
+    ids = {} # xyz: [record ids]
+    last_id = None
+    while True:
+        query = 'SELECT id, xyz, action, color FROM blocklog WHERE %s AND timestamp >= ? AND NOT undone' % match
+        args = match_args + [since]
+        if last_id is not None:
+            query += ' AND id < ?'
+            args.append(last_id)
+        rows = con.execute(query + ' ORDER BY id DESC LIMIT ?', args + [UNDO_BATCH]).fetchall()
+        if not rows:
+            break
+        for record_id, xyz, action, color in rows:
+            first[xyz] = (record_id, action, color)
+            ids.setdefault(xyz, []).append(record_id)
+        last_id = rows[-1][0]
+    changes = []
+    for xyz, (record_id, action, color) in first.items():
+        latest = con.execute('SELECT %s FROM blocklog WHERE xyz = ? AND NOT undone ORDER BY id DESC LIMIT 1' % match,
+                             match_args + [xyz]).fetchone()
+        if not latest[0]: # changed by someone else afterwards
+            del ids[xyz]
+            continue
+        if not action:
+            changes.append((xyz, color))
+            continue
+        previous = con.execute('SELECT action, color FROM blocklog WHERE xyz = ? AND id < ? AND NOT undone ORDER BY id DESC LIMIT 1',
+                               (xyz, record_id)).fetchone()
+        if previous:
+            changes.append((xyz, previous[1] if previous[0] else None))
+        else:
+            changes.append((xyz, False))
+    changes.sort(key=lambda x: x[1] or 0)
+    return changes, ids
+
+def mark_undone(con, ids):
+    con.executemany('UPDATE blocklog SET undone = 1 WHERE id = ?', ((x,) for x in ids))
+    con.commit()
+
+def undo_generator(protocol, changes, ids):
+    """
+    Restore blocks for RollbackProtocol.run_rollback, marking the records of restored blocks undone every UNDO_BATCH
+    blocks and when the undo ends early, so a later undo doesn't replay them
+    """
+    block_action = BlockAction()
+    block_action.player_id = 31
+    set_color = SetColor()
+    set_color.player_id = 31
+    last_color = None
+    original = getattr(protocol, 'snapshots', {}).get('map')
+    restored = [] # xyz of restored blocks whose records are not marked undone yet
+
+    def mark_restored():
+        xyzs = list(restored)
+        del restored[:]
+        protocol.blocklog_writer.submit_task(mark_undone, [x for xyz in xyzs for x in ids[xyz]],
+            callback=lambda result: history_cache.invalidate(xyzs))
+
+    try:
+        for xyz, color in changes:
+            if len(restored) >= UNDO_BATCH:
+                mark_restored()
+            x, y, z = (xyz >> 15) & 511, (xyz >> 6) & 511, xyz & 63
+            if color is False:
+                color = None
+                if original and original.get_solid(x, y, z):
+                    r, g, b = original.get_color(x, y, z)[:3]
+                    color = r << 16 | g << 8 | b
+            if color is not None:
+                color = ((color >> 16) & 255, (color >> 8) & 255, color & 255)
+            solid = protocol.map.get_solid(x, y, z)
+            if (not solid and color is None) or (solid and color and tuple(protocol.map.get_color(x, y, z)[:3]) == color):
+                restored.append(xyz)
+                yield 0
+                continue
+            packets = 0
+            block_action.x, block_action.y, block_action.z = x, y, z
+            if solid:
+                block_action.value = DESTROY_BLOCK
+                protocol.map.remove_point(x, y, z)
+                protocol.broadcast_contained(block_action, save=True)
+                packets += 1
+            if color is not None:
+                if color != last_color:
+                    set_color.value = make_color(*color)
+                    protocol.broadcast_contained(set_color, save=True)
+                    last_color = color
+                    packets += 1
+                block_action.value = BUILD_BLOCK
+                protocol.map.set_point(x, y, z, color)
+                protocol.broadcast_contained(block_action, save=True)
+                packets += 1
+            protocol.mark_dirty(x, y)
+            restored.append(xyz)
+            yield packets
+            yield 0
+    finally: # also runs when a cancelled rollback drops the generator
+        if restored:
+            mark_restored()
+
+def query_box_edits(x1, y1, z1, x2, y2, z2, window):
+    """
+    Count edits inside a box per session and time window. Runs in a thread pool with its own connection
+    """
+    con_read = sqlite3.connect(db_path_log)
+    groups = {} # (session, window start): [placed, broken, first timestamp, last timestamp]
+    for low, high in morton_ranges(x1, y1, z1, x2, y2, z2):
+        for timestamp, xyz, session, action in con_read.execute('SELECT timestamp, xyz, session, action FROM blocklog WHERE morton BETWEEN ? AND ?', (low, high)):
+            x, y, z = (xyz >> 15) & 511, (xyz >> 6) & 511, xyz & 63
+            if not (x1 <= x <= x2 and y1 <= y <= y2 and z1 <= z <= z2):
+                continue
+            group = groups.setdefault((session, timestamp - timestamp % window), [0, 0, timestamp, timestamp])
+            group[0 if action else 1] += 1
+            group[2] = min(group[2], timestamp)
+            group[3] = max(group[3], timestamp)
+    con_read.close()
+    return sorted([(key[0],) + tuple(value) for key, value in groups.items()], key=lambda x: x[3])
+
+history_cache = HistoryCache(HISTORY_CACHE_SIZE_OPTION.get())
+
+def get_history(xyz, offset, limit):
+    rows = history_cache.get(xyz, offset, limit)
+    if rows is None and segment_store:
+        rows = segment_store.history(xyz, offset, limit)
+        history_cache.put(xyz, offset, limit, rows)
+    elif rows is None:
+        cur_log = con_log.cursor()
+        rows = cur_log.execute('SELECT id, timestamp, xyz, session, action, color, undone FROM blocklog WHERE xyz = ? ORDER BY id DESC LIMIT ?, ?', (
+            xyz, offset, limit)).fetchall()
+        cur_log.close()
+        history_cache.put(xyz, offset, limit, rows)
+    return list(rows)
+
+
+class BlockLogWriter(threading.Thread):
+    """
+    Writes flushed batches into blocklog.db using its own connection so the reactor never waits on disk I/O
+    """
+
+    def __init__(self, path, on_written=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.on_written = on_written
+        self.batches = queue.Queue() # (function, args, callback)
+        self.lock = threading.Lock()
+        self.pending = deque() # (time queued, number of rows) for batches not written yet
+        self.pending_rows = 0
+        self.last_duration = 0
+
+    def submit(self, rows, counts=None):
+        with self.lock:
+            self.pending.append((time.monotonic(), len(rows)))
+            self.pending_rows += len(rows)
+        self.batches.put((self.write_rows, (rows, counts or {}), self.on_written))
+
+    def submit_task(self, func, *args, callback=None):
+        """
+        Run func(con, *args) on the writer thread after the batches queued before it. callback gets the result on the reactor thread
+        """
+        self.batches.put((func, args, callback))
+
+    def lag(self):
+        with self.lock:
+            if self.pending:
+                return self.pending_rows, time.monotonic() - self.pending[0][0]
+            return 0, 0
+
+    def write_rows(self, con, rows, counts):
+        start = time.monotonic()
+        try:
+            if segment_store:
+                segment_store.append(rows)
+            else:
+                con.executemany('INSERT INTO blocklog(timestamp, xyz, session, action, color, undone, morton) VALUES(?, ?, ?, ?, ?, ?, ?)',
+                                (x + (morton(x[1]),) for x in rows))
+            for user, (placed, destroyed) in counts.items():
+                con.execute('INSERT OR IGNORE INTO block_counts(user, placed, destroyed) VALUES(?, 0, 0)', (user,))
+                con.execute('UPDATE block_counts SET placed = placed + ?, destroyed = destroyed + ? WHERE user = ?', (placed, destroyed, user))
+            con.commit()
+        finally:
+            # A failed batch is dropped rather than counted as backlog forever
+            self.last_duration = time.monotonic() - start
+            with self.lock:
+                self.pending.popleft()
+                self.pending_rows -= len(rows)
+        return rows
+
+    def run(self):
+        con = sqlite3.connect(self.path)
+        con.execute('PRAGMA journal_mode=WAL')
+        while True:
+            task = self.batches.get()
+            if task is None:
+                break
+            func, args, callback = task
+            try:
+                result = func(con, *args)
+            except Exception:
+                # One failing task (locked or full database, bad row) must not stop logging for good
+                log.failure('Block log task {func} failed', func=getattr(func, '__name__', func))
+                con.rollback()
+                continue
+            if callback:
+                reactor.callFromThread(callback, result)
+        con.close()
+
+    def stop(self):
+        self.batches.put(None)
+        self.join()
+
 @command('history', 'h', 'i')
 def history(connection):
     """
@@ -54,15 +663,147 @@ def blocks(connection, player=None):
     """
     if not player:
         player = connection.name
-    cur = con.cursor()
-    sessions = [x[0] for x in cur.execute('SELECT id FROM sessions WHERE user = ?', (player,)).fetchall()]
-    cur.close()
     cur_log = con_log.cursor()
-    block_count = cur_log.execute('SELECT COUNT(*) FROM blocklog WHERE action = 1 AND session IN (%s)' %
-        ','.join('?'*len(sessions)), sessions).fetchone()[0]
+    res = cur_log.execute('SELECT placed FROM block_counts WHERE user = ?', (player,)).fetchone()
     cur_log.close()
+    block_count = res[0] if res else 0
     return "%s placed %s blocks" % (player, f'{block_count:,}')
 
+def rebuild_block_counts(con_log):
+    start = time.monotonic()
+    con_log.execute('ATTACH DATABASE ? AS sessions_db', (db_path,))
+    con_log.execute('DELETE FROM block_counts')
+    con_log.execute('DELETE FROM block_counts_backfill') # the rebuild counts those records as well
+    # records removed by compaction only survive in block_counts_archived
+    con_log.execute('INSERT INTO block_counts(user, placed, destroyed) SELECT user, SUM(placed), SUM(destroyed) FROM ('
+                    'SELECT s.user AS user, b.action = 1 AS placed, b.action = 0 AS destroyed '
+                    'FROM blocklog b JOIN sessions_db.sessions s ON s.id = b.session '
+                    'UNION ALL SELECT user, placed, destroyed FROM block_counts_archived) GROUP BY user COLLATE NOCASE')
+    con_log.commit()
+    con_log.execute('DETACH DATABASE sessions_db')
+    return time.monotonic() - start
+
+@command(admin_only=True)
+def blockcountsrebuild(connection):
+    """
+    Recount placed and destroyed blocks per player from the whole log
+    /blockcountsrebuild
+    """
+    if segment_store:
+        return "Block counts can only be rebuilt from the sqlite storage"
+    protocol = connection.protocol
+    protocol.commit_blocklog_queue()
+    protocol.blocklog_writer.submit_task(rebuild_block_counts,
+        callback=lambda elapsed: protocol.notify_admins("Block counts rebuilt in %.1fs" % elapsed))
+    return "Rebuilding block counts..."
+
+@command(admin_only=True)
+def edits(connection, minutes=10):
+    """
+    List edits inside the current selection grouped by session and time window
+    /edits <window in minutes>
+    """
+    if segment_store:
+        return "Area lookups need the sqlite storage"
+    window = int(float(minutes) * 60)
+    if window < 1:
+        return "Usage: /edits <window in minutes, more than 0>"
+    if not (getattr(connection, 'sel_a', None) and getattr(connection, 'sel_b', None)):
+        return "Select an area using /sel first"
+    box = [min(x) for x in zip(connection.sel_a, connection.sel_b)] + [max(x) for x in zip(connection.sel_a, connection.sel_b)]
+    connection.protocol.commit_blocklog_queue()
+
+    def show(groups):
+        if not groups:
+            connection.send_chat("No edits found in selection")
+            return
+        users = connection.protocol.get_session_users([x[0] for x in groups])
+        for session, placed, broken, first, last in groups[-8:]:
+            connection.send_chat("%s - %s | %s | %s | placed %s, broke %s" % (
+                datetime.datetime.fromtimestamp(first).isoformat(sep=' ')[2:16],
+                datetime.datetime.fromtimestamp(last).isoformat(sep=' ')[11:16],
+                session, users[session], placed, broken))
+        connection.send_chat("%s group(s) of edits in selection%s" % (len(groups), ', showing latest 8' if len(groups) > 8 else ''))
+
+    deferToThread(query_box_edits, *box, window).addCallback(show)
+    return "Looking up edits..."
+
+@command(admin_only=True)
+def undoedits(connection, player, since='24h'):
+    """
+    Revert blocks changed by a player or session since given time. Blocks edited by someone else afterwards are kept
+    /undoedits <player or #session> <time, e.g. 30m/2h/3d>
+    """
+    protocol = connection.protocol
+    if segment_store:
+        return "Undo is only available for the sqlite storage"
+    if not hasattr(protocol, 'run_rollback'):
+        return "Undo requires rollback.py"
+    if protocol.rollback_in_progress or protocol.rollback_scan_call is not None:
+        return "Rollback in progress"
+    session = None
+    if player.startswith('#'):
+        player, session = None, int(player[1:])
+    else:
+        cur = con.cursor()
+        found = cur.execute('SELECT 1 FROM sessions WHERE user = ? LIMIT 1', (player,)).fetchone()
+        cur.close()
+        if not found:
+            return "No sessions found for this player"
+    since = int(time.time() - parse_duration(since))
+
+    def start(result):
+        changes, ids = result
+        if not changes:
+            connection.send_chat("No edits to undo")
+            return
+        if protocol.rollback_scan_call is not None: # a rollback started scanning while the edits were looked up
+            connection.send_chat("Rollback in progress")
+            return
+        message = protocol.run_rollback(connection, undo_generator(protocol, changes, ids), len(changes))
+        if message:
+            connection.send_chat(message)
+
+    protocol.commit_blocklog_queue()
+    protocol.blocklog_writer.submit_task(plan_undo, player, session, since, callback=start)
+    return "Looking up edits..."
+
+@command(admin_only=True)
+def blocklogcompact(connection):
+    """
+    Archive old records, collapse repaints and vacuum blocklog.db
+    /blocklogcompact
+    """
+    return connection.protocol.start_blocklog_compaction(connection)
+
+@command(admin_only=True)
+def blocklogvacuum(connection):
+    """
+    Rebuild blocklog.db with a full VACUUM, which lets compaction reclaim space of databases created by older versions.
+    Block operations are queued until it finishes
+    /blocklogvacuum
+    """
+    protocol = connection.protocol
+    if segment_store:
+        return "Vacuum is only available for the sqlite storage"
+    if protocol.blocklog_compaction:
+        return "Compaction is already running"
+    protocol.commit_blocklog_queue()
+    protocol.blocklog_writer.submit_task(full_vacuum,
+        callback=lambda elapsed: protocol.notify_admins("blocklog.db vacuumed in %.1fs" % elapsed))
+    return "Vacuuming blocklog.db..."
+
+@command(admin_only=True)
+def blocklogstatus(connection):
+    """
+    Show how far behind the block log writer is
+    /blocklogstatus
+    """
+    protocol = connection.protocol
+    rows, age = protocol.blocklog_writer.lag()
+    return "Queued: %s | Writing: %s rows (%.1fs behind) | Last write took %.3fs" % (
+        len(protocol.blocklog_queue), rows, age, protocol.blocklog_writer.last_duration)
+
 
 def apply_script(protocol, connection, config):
     class BlockLogConnection(connection):
@@ -117,12 +858,12 @@ def apply_script(protocol, connection, config):
                         xyz = x << 15 | y << 6 | z-(i-1)
                         r, g, b = self.block_destroy_color[i]
                         color = r << 16 | g << 8 | b
-                        self.protocol.blocklog_queue += [(int(datetime.datetime.now(datetime.timezone.utc).timestamp()), xyz, self.session, False, color, False,)]
+                        self.protocol.log_block(int(datetime.datetime.now(datetime.timezone.utc).timestamp()), xyz, self.session, False, color)
             elif type(self.block_destroy_color[0]) == type(int()):
                 xyz = x << 15 | y << 6 | z
                 r, g, b = self.block_destroy_color
                 color = r << 16 | g << 8 | b
-                self.protocol.blocklog_queue += [(int(datetime.datetime.now(datetime.timezone.utc).timestamp()), xyz, self.session, False, color, False,)]
+                self.protocol.log_block(int(datetime.datetime.now(datetime.timezone.utc).timestamp()), xyz, self.session, False, color)
 
         def on_block_build(self, x, y, z):
             if connection.on_block_build(self, x, y, z) == False:
@@ -131,9 +872,7 @@ def apply_script(protocol, connection, config):
             r, g, b = self.color
             color = r << 16 | g << 8 | b
             timestamp = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-            self.protocol.blocklog_queue = [None if (x[1] == xyz and x[3] == True) else x for x in self.protocol.blocklog_queue] # reduce repeating entries (e.g. from painting)
-            self.protocol.blocklog_queue = [x for x in self.protocol.blocklog_queue if x]
-            self.protocol.blocklog_queue += [(timestamp, xyz, self.session, True, color, False,)]
+            self.protocol.log_block(timestamp, xyz, self.session, True, color, True) # reduce repeating entries (e.g. from painting)
 
         def on_line_build(self, points):
             if connection.on_line_build(self, points) == False:
@@ -143,7 +882,7 @@ def apply_script(protocol, connection, config):
                 xyz = x << 15 | y << 6 | z
                 r, g, b = self.color
                 color = r << 16 | g << 8 | b
-                self.protocol.blocklog_queue += [(int(datetime.datetime.now(datetime.timezone.utc).timestamp()), xyz, self.session, True, color, False,)]
+                self.protocol.log_block(int(datetime.datetime.now(datetime.timezone.utc).timestamp()), xyz, self.session, True, color)
 
         def on_orientation_update(self, x, y, z):
             if self.history_mode:
@@ -152,13 +891,9 @@ def apply_script(protocol, connection, config):
                     if self.last_cast_ray_block:
                         x, y, z = self.last_cast_ray_block
                         xyz = x << 15 | y << 6 | z
-                        cur_log = con_log.cursor()
-                        res = cur_log.execute('SELECT id, timestamp, xyz, session, action, color, undone FROM blocklog WHERE xyz = ? ORDER BY id DESC', (
-                            xyz,)).fetchone()
-                        cur_log.close()
+                        res = get_history(xyz, 0, 1)
                         if res:
-                            action_id, timestamp, xyz, session, action, color, undone = res
-                            cur = con.cursor()
+                            action_id, timestamp, xyz, session, action, color, undone = res[0]
                             self.send_cmsg("%s | %s | %s %s %s %s | %s | %s %s #%02X%02X%02X %s" % (
                                 action_id,
                                 datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ')[2:16],
@@ -167,14 +902,13 @@ def apply_script(protocol, connection, config):
                                 xyz & 63,
                                 chr(int(x // 64) + ord('A')) + str(y // 64 + 1),
                                 session,
-                                cur.execute('SELECT user FROM sessions WHERE id = ?', (session,)).fetchone()[0],
+                                self.protocol.get_session_users([session])[session],
                                 'placed' if action else 'broke',
                                 (color >> 16) & 255, (color >> 8) & 255, color & 255,
                                 '[rollbacked]' if undone else '',
                                 ),
                                 'Notice'
                             )
-                            cur.close()
                         else:
                             self.send_cmsg("No history found for these coordinates", 'Notice')
             connection.on_orientation_update(self, x, y, z)
@@ -191,17 +925,14 @@ def apply_script(protocol, connection, config):
                         if xyz != self.last_checked_block:
                             self.last_checked_block = xyz
                             self.number_of_clicks = 0
-                        cur_log = con_log.cursor()
-                        res = cur_log.execute('SELECT id, timestamp, xyz, session, action, color, undone FROM blocklog WHERE xyz = ? ORDER BY id DESC LIMIT ?, ?', (
-                            xyz, self.number_of_clicks * results_per_page, (self.number_of_clicks + 1) * results_per_page)).fetchall()
-                        cur_log.close()
+                        res = get_history(xyz, self.number_of_clicks * results_per_page, (self.number_of_clicks + 1) * results_per_page)
                         if xyz == self.last_checked_block:
                             self.number_of_clicks += 1
                         if res:
                             res.reverse()
+                            users = self.protocol.get_session_users([x[3] for x in res])
                             for i in res:
                                 action_id, timestamp, xyz, session, action, color, undone = i
-                                cur = con.cursor()
                                 self.send_chat("%s | %s | %s %s %s %s | %s | %s %s #%02X%02X%02X %s \0" % (
                                     action_id,
                                     datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ')[2:16],
@@ -210,13 +941,12 @@ def apply_script(protocol, connection, config):
                                     xyz & 63,
                                     chr(int(x // 64) + ord('A')) + str(y // 64 + 1),
                                     session,
-                                    cur.execute('SELECT user FROM sessions WHERE id = ?', (session,)).fetchone()[0],
+                                    users[session],
                                     '\5placed\6' if action else '\4broke\6',
                                     (color >> 16) & 255, (color >> 8) & 255, color & 255,
                                     '[rollbacked]' if undone else '',
                                     )
                                 )
-                                cur.close()
                             self.send_chat("[Page %s]" % self.number_of_clicks)
                             if len(res) < results_per_page:
                                 self.number_of_clicks = 0
@@ -240,20 +970,117 @@ def apply_script(protocol, connection, config):
             connection.on_disconnect(self)
 
     class BlockLogProtocol(protocol):
-        blocklog_queue = []
         blocklog_loop = None
 
         def __init__(self, *arg, **kw):
             protocol.__init__(self, *arg, **kw)
+            self.blocklog_queue = [] # append log, replaced entries are set to None
+            self.blocklog_builds = {} # xyz: index of the latest queued build entry
+            self.blocklog_flush_size = FLUSH_SIZE_OPTION.get()
+            self.blocklog_writer = BlockLogWriter(db_path_log, self.on_blocklog_written)
+            self.blocklog_writer.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop_blocklog_writer)
+            if not segment_store:
+                self.blocklog_writer.submit_task(create_indexes)
+                self.blocklog_writer.submit_task(backfill_morton, callback=self.on_morton_backfilled)
+                self.blocklog_writer.submit_task(backfill_block_counts, callback=self.on_block_counts_backfilled)
             self.blocklog_loop = LoopingCall(self.commit_blocklog_queue)
-            self.blocklog_loop.start(180)
+            self.blocklog_loop.start(FLUSH_INTERVAL_OPTION.get())
+            self.blocklog_compaction = None
+            self.blocklog_compact_loop = None
+            if COMPACT_INTERVAL_OPTION.get() and not segment_store:
+                self.blocklog_compact_loop = LoopingCall(self.start_blocklog_compaction)
+                self.blocklog_compact_loop.start(COMPACT_INTERVAL_OPTION.get() * 3600, now=False)
+
+        def log_block(self, timestamp, xyz, session, action, color, replace=False):
+            if replace:
+                i = self.blocklog_builds.get(xyz)
+                if i is not None:
+                    self.blocklog_queue[i] = None
+            if action:
+                self.blocklog_builds[xyz] = len(self.blocklog_queue)
+            self.blocklog_queue.append((timestamp, xyz, session, action, color, False,))
+            if len(self.blocklog_queue) >= self.blocklog_flush_size:
+                self.commit_blocklog_queue()
 
         def commit_blocklog_queue(self):
             if self.blocklog_queue:
-                cur_log = con_log.cursor()
-                cur_log.executemany('INSERT INTO blocklog(timestamp, xyz, session, action, color, undone) VALUES(?, ?, ?, ?, ?, ?)', iter(self.blocklog_queue))
-                con_log.commit()
-                cur_log.close()
+                rows = [x for x in self.blocklog_queue if x]
+                users = self.get_session_users([x[2] for x in rows])
+                counts = {} # user: [placed, destroyed]
+                for row in rows:
+                    user = users.get(row[2])
+                    if user:
+                        counts.setdefault(user.lower(), [0, 0])[0 if row[3] else 1] += 1
+                self.blocklog_writer.submit(rows, counts)
                 self.blocklog_queue = []
+                self.blocklog_builds = {}
+
+        def on_blocklog_written(self, rows):
+            history_cache.invalidate(set(x[1] for x in rows))
+
+        def on_morton_backfilled(self, count):
+            if count:
+                self.blocklog_writer.submit_task(backfill_morton, callback=self.on_morton_backfilled)
+
+        def on_block_counts_backfilled(self, more):
+            if more:
+                self.blocklog_writer.submit_task(backfill_block_counts, callback=self.on_block_counts_backfilled)
+
+        # compaction runs as a chain of small writer tasks so new block operations are written between slices
+
+        def start_blocklog_compaction(self, connection=None):
+            if segment_store:
+                return "Compaction is only available for the sqlite storage"
+            if self.blocklog_compaction:
+                return "Compaction is already running"
+            self.blocklog_compaction = {'connection': connection, 'start': time.monotonic(), 'size': 0,
+                                        'incremental': True, 'archived': 0, 'collapsed': 0, 'x': 0}
+            cutoff = int(time.time()) - ARCHIVE_AFTER_DAYS_OPTION.get() * 86400
+            def prepared(result):
+                self.blocklog_compaction['size'], self.blocklog_compaction['incremental'] = result
+                if ARCHIVE_AFTER_DAYS_OPTION.get():
+                    self.blocklog_writer.submit_task(compact_archive, cutoff, callback=archived)
+                else:
+                    archived(0)
+            def archived(count):
+                self.blocklog_compaction['archived'] += count
+                if count:
+                    self.blocklog_writer.submit_task(compact_archive, cutoff, callback=archived)
+                else:
+                    self.blocklog_writer.submit_task(compact_collapse, 0, callback=collapsed)
+            def collapsed(count):
+                self.blocklog_compaction['collapsed'] += count
+                self.blocklog_compaction['x'] += 1
+                if self.blocklog_compaction['x'] < 512:
+                    self.blocklog_writer.submit_task(compact_collapse, self.blocklog_compaction['x'], callback=collapsed)
+                elif self.blocklog_compaction['incremental']:
+                    self.blocklog_writer.submit_task(compact_vacuum, callback=vacuumed)
+                else: # incremental_vacuum would free nothing
+                    self.blocklog_writer.submit_task(database_size, callback=self.end_blocklog_compaction)
+            def vacuumed(result):
+                free_pages, size = result
+                if free_pages:
+                    self.blocklog_writer.submit_task(compact_vacuum, callback=vacuumed)
+                else:
+                    self.end_blocklog_compaction(size)
+            self.commit_blocklog_queue()
+            self.blocklog_writer.submit_task(compact_prepare, callback=prepared)
+            return "Block log compaction started"
+
+        def end_blocklog_compaction(self, size):
+            state = self.blocklog_compaction
+            self.blocklog_compaction = None
+            history_cache.pages.clear()
+            message = "Block log compacted in %.1fs: archived %s, collapsed %s, reclaimed %.1f MB" % (
+                time.monotonic() - state['start'], f"{state['archived']:,}", f"{state['collapsed']:,}",
+                max(state['size'] - size, 0) / 1048576)
+            log.info(message)
+            if state['connection'] and state['connection'] in self.players.values():
+                state['connection'].send_chat(message)
+
+        def stop_blocklog_writer(self):
+            self.commit_blocklog_queue()
+            self.blocklog_writer.stop()
 
     return BlockLogProtocol, BlockLogConnection
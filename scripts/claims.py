@@ -1,7 +1,8 @@
 """
 Lets registered players claim 64x64 sectors of the map and share them with other players.
+Smaller rectangular plots can be claimed inside unclaimed and public sectors.
 
-Requires auth.py
+Requires auth.py and fogtween.py
 
 May conflict with building scripts (building scripts either don't work, or blocks in claimed sectors become breakable by anyone)
 paint.py, sculpt.py and other scripts in this repo are edited for compatibility.
@@ -17,7 +18,7 @@ from piqueserver.config import config
 from pyspades.color import interpolate_rgb
 from pyspades.common import escape_control_codes, coordinates, make_color
 from pyspades.constants import BUILD_BLOCK, DESTROY_BLOCK
-from pyspades.contained import BlockAction, FogColor, SetColor
+from pyspades.contained import BlockAction, SetColor
 
 db_path = os.path.join(config.config_dir, 'sqlite.db')
 con = sqlite3.connect(db_path)
@@ -25,13 +26,19 @@ cur = con.cursor()
 cur.execute('CREATE TABLE IF NOT EXISTS claims(sector, owner COLLATE NOCASE, dt, name, mode, fog)')
 cur.execute('CREATE TABLE IF NOT EXISTS shared(sector, player COLLATE NOCASE, dt)')
 cur.execute('CREATE TABLE IF NOT EXISTS signs(x, y, z, text)')
+cur.execute('CREATE TABLE IF NOT EXISTS plots(id INTEGER PRIMARY KEY, x1, y1, x2, y2, owner COLLATE NOCASE, dt)')
+cur.execute('CREATE TABLE IF NOT EXISTS plot_shared(plot, player COLLATE NOCASE, dt)')
 con.commit()
 cur.close()
 
 SECTORS_PER_PLAYER = 5
+PLOTS_PER_PLAYER = 8
+PLOT_CELL = 16 # Size of a plot index grid cell in blocks
+PLOT_GRID = 512 // PLOT_CELL
+SPAWN_SAMPLES = 16 # Columns per sector kept as spawn candidates
 
 cur = con.cursor()
-SIGNS = cur.execute('SELECT x, y, z FROM signs').fetchall()
+SIGNS = {(x, y, z): text for x, y, z, text in cur.execute('SELECT x, y, z, text FROM signs').fetchall()}
 cur.close()
 
 
@@ -40,6 +47,39 @@ ALL_SECTORS = [chr(x // 8 + ord('A')) + str(x % 8 + 1) for x in range(64)]
 def get_sector(x, y):
     return chr(int(x // 64) + ord('A')) + str(int(y) // 64 + 1)
 
+def sector_index(sector):
+    return (ord(sector[0]) - ord('A')) * 8 + int(sector[1:]) - 1
+
+def area_sectors(x1, y1, x2, y2):
+    # Bitmask of sectors (bit = sector_index) overlapped by a box between two corners, clipped to the map
+    x1, x2 = sorted((min(max(int(x1), 0), 511), min(max(int(x2), 0), 511)))
+    y1, y2 = sorted((min(max(int(y1), 0), 511), min(max(int(y2), 0), 511)))
+    mask = 0
+    for sx in range(x1 // 64, x2 // 64 + 1):
+        for sy in range(y1 // 64, y2 // 64 + 1):
+            mask |= 1 << (sx * 8 + sy)
+    return mask
+
+def points_sectors(points):
+    # Bitmask of sectors containing any of the points. Points outside the map are ignored
+    mask = 0
+    for sx, sy in set((int(p[0]) // 64, int(p[1]) // 64) for p in points if 0 <= p[0] < 512 and 0 <= p[1] < 512):
+        mask |= 1 << (sx * 8 + sy)
+    return mask
+
+def mask_sectors(mask):
+    return [chr(i // 8 + ord('A')) + str(i % 8 + 1) for i in range(64) if mask >> i & 1]
+
+def plot_cells(x1, y1, x2, y2):
+    # Indexes of the plot grid cells overlapped by a box with inclusive corners
+    for cx in range(x1 // PLOT_CELL, x2 // PLOT_CELL + 1):
+        for cy in range(y1 // PLOT_CELL, y2 // PLOT_CELL + 1):
+            yield cx * PLOT_GRID + cy
+
+def plots_info(protocol, x1, y1, x2, y2):
+    plots = sorted(protocol.plots_in_area(x1, y1, x2, y2))
+    return ', '.join('#%s <%s> %s,%s-%s,%s' % ((plot_id, protocol.plots[plot_id][4]) + tuple(protocol.plots[plot_id][:4])) for plot_id in plots)
+
 def claimed_by(sector, name=None):
     cur = con.cursor()
     query = cur.execute('SELECT sector, owner FROM claims WHERE sector = ?', (sector,)).fetchone()
@@ -80,6 +120,10 @@ def claim(connection, sector):
     elif owner == None:
         return "Sector %s is reserved and can't be claimed. You can claim one of the /free sectors" % sector
     else:
+        sx, sy = coordinates(sector)
+        for plot_id in connection.protocol.plots_in_area(sx, sy, sx + 63, sy + 63):
+            if connection.protocol.plots[plot_id][4].lower() != connection.name.lower():
+                return "Sector %s has plots claimed by other players. You can claim one of the /free sectors" % sector
         cur = con.cursor()
         owned_by_player = cur.execute('SELECT sector FROM claims WHERE owner = ?', (connection.name,)).fetchall()
         cur.close()
@@ -90,6 +134,7 @@ def claim(connection, sector):
         cur.execute('INSERT INTO claims(sector, owner, dt) VALUES(?, ?, ?)', (sector, connection.name, datetime.now().isoformat(sep=' ')[:16]))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         connection.protocol.notify_admins("%s claimed %s" % (connection.name, sector))
         return "Sector %s now belongs to you. Use /share to let other players build with you" % sector
 
@@ -108,6 +153,11 @@ def sector(connection, sector=None):
             x, y, z = connection.get_location()
             sector = get_sector(x, y)
 
+    sx, sy = coordinates(sector)
+    plots = plots_info(connection.protocol, sx, sy, sx + 63, sy + 63)
+    if plots:
+        connection.send_chat("Plots: " + plots)
+
     owner = claimed_by(sector, connection.name)
     if owner == False:
         return "Sector %s is unclaimed" % sector
@@ -152,6 +202,7 @@ def title(connection, sector, *name):
         cur.execute('UPDATE claims SET name = ? WHERE sector = ?', (name, sector))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         connection.protocol.notify_admins("%s named %s \"%s\"" % (connection.name, sector, name))
         if name:
             return "Claim is now named %s" % name
@@ -179,12 +230,12 @@ def sign(connection, *text):
                 cur.execute('UPDATE signs SET text = ? WHERE x = ? AND y = ? AND z = ?', (text, x, y, z))
             else:
                 cur.execute('INSERT INTO signs(x, y, z, text) VALUES(?, ?, ?, ?)', (x, y, z, text))
-            SIGNS.append((x, y, z))
+            SIGNS[(x, y, z)] = text
             connection.protocol.notify_admins("%s signed a block \"%s\"" % (connection.name, text))
         else:
             text = ''
             cur.execute('DELETE FROM signs WHERE x = ? AND y = ? AND z = ?', (x, y, z))
-            SIGNS.remove((x, y, z))
+            SIGNS.pop((x, y, z), None)
             connection.protocol.notify_admins("%s unsigned a block" % connection.name)
         con.commit()
         cur.close()
@@ -278,6 +329,7 @@ def unclaim(connection, sector):
         cur.execute('DELETE FROM shared WHERE sector = ?', (sector,))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         connection.protocol.notify_admins("Sector %s has been unclaimed by %s" % (sector, connection.name))
         return "Sector %s has been unclaimed" % sector
     return "You can only unclaim your sectors"
@@ -321,6 +373,7 @@ def share(connection, sector, *player):
         cur.execute('INSERT INTO shared(sector, player, dt) VALUES(?, ?, ?)', (sector, player, datetime.now().isoformat(sep=' ')[:16]))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         if not get_player(connection.protocol, player).logged_in:
             connection.protocol.notify_player("Please /login to build there", player)
     elif player.lower() in players_online:
@@ -368,6 +421,7 @@ def unshare(connection, sector, *player):
     cur.execute('DELETE FROM shared WHERE sector = ? AND player = ?', (sector, player))
     con.commit()
     cur.close()
+    connection.protocol.reload_claim(sector)
 
     connection.protocol.notify_player("You can no longer build in %s" % sector, player)
     connection.protocol.notify_admins("%s unshared %s for %s" % (connection.name, sector, player))
@@ -399,11 +453,13 @@ def public(connection, sector):
             cur.execute('UPDATE claims SET mode = ? WHERE sector = ?', (None, sector))
             con.commit()
             cur.close()
+            connection.protocol.reload_claim(sector)
             connection.protocol.notify_admins("%s made %s private" % (connection.name, sector))
             return "Sector %s is no longer public" % sector
     cur.execute('UPDATE claims SET mode = ? WHERE sector = ?', ('public', sector))
     con.commit()
     cur.close()
+    connection.protocol.reload_claim(sector)
     connection.protocol.notify_admins("%s made %s public" % (connection.name, sector))
     return "Sector %s is now public" % sector
     return "You can only manage sectors you claim. Claim a sector using /claim first"
@@ -434,11 +490,13 @@ def quest(connection, sector):
             cur.execute('UPDATE claims SET mode = ? WHERE sector = ?', (None, sector))
             con.commit()
             cur.close()
+            connection.protocol.reload_claim(sector)
             connection.protocol.notify_admins("%s unset %s from quest mode" % (connection.name, sector))
             return "Sector %s is no longer in quest mode" % sector
     cur.execute('UPDATE claims SET mode = ? WHERE sector = ?', ('quest', sector))
     con.commit()
     cur.close()
+    connection.protocol.reload_claim(sector)
     connection.protocol.notify_admins("%s set %s into quest mode" % (connection.name, sector))
     return "Sector %s is now in quest mode" % sector
 
@@ -459,6 +517,7 @@ def reserve(connection, sector):
         cur.execute('INSERT INTO shared(sector, player, dt) VALUES(?, ?, ?)', (sector, owner, datetime.now().isoformat(sep=' ')[:16]))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         connection.protocol.notify_admins("Sector %s has been reserved by %s" % (sector, connection.name))
         return "Sector %s has been reserved" % sector
     elif owner == False:
@@ -466,6 +525,7 @@ def reserve(connection, sector):
         cur.execute('INSERT INTO claims(sector, owner, dt) VALUES(?, ?, ?)', (sector, None, datetime.now().isoformat(sep=' ')[:16]))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         connection.protocol.notify_admins("Sector %s has been reserved by %s" % (sector, connection.name))
         return "Sector %s has been reserved" % sector
     elif owner == None:
@@ -490,6 +550,7 @@ def setfog(connection, sector, *color):
             cur.execute('UPDATE claims SET fog = ? WHERE sector = ?', ('#%02X%02X%02X ' % color, sector))
             con.commit()
             cur.close()
+            connection.protocol.reload_claim(sector)
             return str(connection.protocol.fog_color)
 
     owner = claimed_by(sector, connection.name)
@@ -518,9 +579,159 @@ def setfog(connection, sector, *color):
             connection.protocol.notify_admins("%s removed fog color in %s" % (connection.name, sector))
         con.commit()
         cur.close()
+        connection.protocol.reload_claim(sector)
         return "Claim fog color updated"
     return "You can only manage sectors you claim. Claim a sector using /claim first"
 
+@command()
+def plot(connection, *args):
+    """
+    Claim a rectangular plot inside an unclaimed or public sector
+    /plot <size> - square plot around you, 16 by default
+    /plot <x1> <y1> <x2> <y2> - plot between two corners
+    """
+    if not connection.logged_in:
+        return "To claim a plot you have to log in first. Use /reg to register and /login to log in"
+    try:
+        if len(args) == 4:
+            x1, y1, x2, y2 = [int(x) for x in args]
+        elif len(args) <= 1:
+            if not connection.world_object:
+                return "You have to be alive to claim a plot around you"
+            size = int(args[0]) if args else 16
+            if not 1 <= size <= 64:
+                return "Plot size has to be between 1 and 64"
+            x, y, z = connection.get_location()
+            x1, y1 = int(x) - size // 2, int(y) - size // 2
+            x2, y2 = x1 + size - 1, y1 + size - 1
+        else:
+            return "Usage: /plot <size> or /plot <x1> <y1> <x2> <y2>"
+    except ValueError:
+        return "Coordinates and size have to be whole numbers"
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    if x1 < 0 or y1 < 0 or x2 > 511 or y2 > 511:
+        return "Plot has to be within the map"
+    sector = get_sector(x1, y1)
+    if get_sector(x2, y2) != sector:
+        return "Plot has to fit within one sector"
+    claim = connection.protocol.claims[sector_index(sector)]
+    if claim and claim[1] != 'public':
+        return "Plots can only be claimed in unclaimed or public sectors. See /free"
+
+    protocol = connection.protocol
+    if protocol.plots_in_area(x1, y1, x2, y2):
+        return "Plot overlaps another plot: " + plots_info(protocol, x1, y1, x2, y2)
+    if len([x for x in protocol.plots.values() if x[4].lower() == connection.name.lower()]) >= PLOTS_PER_PLAYER:
+        return "You've reached the limit of claimed plots. To claim another plot, you have to /unplot one of your plots first"
+
+    cur = con.cursor()
+    cur.execute('INSERT INTO plots(x1, y1, x2, y2, owner, dt) VALUES(?, ?, ?, ?, ?, ?)', (x1, y1, x2, y2, connection.name, datetime.now().isoformat(sep=' ')[:16]))
+    plot_id = cur.lastrowid
+    con.commit()
+    cur.close()
+    protocol.reload_plot(plot_id)
+    protocol.notify_admins("%s claimed plot #%s in %s" % (connection.name, plot_id, sector))
+    return "Plot #%s (%s,%s-%s,%s) in %s now belongs to you. Use /plotshare to let other players build with you" % (plot_id, x1, y1, x2, y2, sector)
+
+def get_plot_arg(connection, plot_id):
+    # Plot given as #id/id, or the one the player is standing in
+    if plot_id:
+        try:
+            plot_id = int(plot_id.strip('#'))
+        except ValueError:
+            return None
+        return plot_id if plot_id in connection.protocol.plots else None
+    if connection.world_object:
+        x, y, z = connection.get_location()
+        return connection.protocol.get_plot(x, y)
+
+@command()
+def unplot(connection, plot_id=None):
+    """
+    Unclaim a plot
+    /unplot <#id> - plot you're standing in if omitted
+    """
+    if not connection.logged_in:
+        return "Log in using /login to make changes to your plot"
+    plot_id = get_plot_arg(connection, plot_id)
+    if plot_id is None:
+        return "Plot not found"
+    if connection.protocol.plots[plot_id][4].lower() != connection.name.lower() and not connection.admin:
+        return "You can only unclaim your plots"
+    cur = con.cursor()
+    cur.execute('DELETE FROM plots WHERE id = ?', (plot_id,))
+    cur.execute('DELETE FROM plot_shared WHERE plot = ?', (plot_id,))
+    con.commit()
+    cur.close()
+    connection.protocol.reload_plot(plot_id)
+    connection.protocol.notify_admins("Plot #%s has been unclaimed by %s" % (plot_id, connection.name))
+    return "Plot #%s has been unclaimed" % plot_id
+
+@command()
+def plotshare(connection, plot_id, *player):
+    """
+    Let another registered player build in a plot
+    /plotshare <#id> <player>
+    """
+    if not connection.logged_in:
+        return "Log in using /login to make changes to your plot"
+    plot_id = get_plot_arg(connection, plot_id)
+    if plot_id is None:
+        return "Plot not found"
+    if connection.protocol.plots[plot_id][4].lower() != connection.name.lower() and not connection.admin:
+        return "You can only share your plots"
+    player = ' '.join(player)
+    if not player or player.lower() in connection.protocol.plots[plot_id][5] | {connection.name.lower()}:
+        return "Enter the name of the player you want to let to build in that plot"
+
+    cur = con.cursor()
+    if not cur.execute('SELECT user FROM users WHERE user = ? COLLATE NOCASE', (player,)).fetchone():
+        cur.close()
+        return "Player not found. Plots can only be shared with registered players"
+    cur.execute('INSERT INTO plot_shared(plot, player, dt) VALUES(?, ?, ?)', (plot_id, player, datetime.now().isoformat(sep=' ')[:16]))
+    con.commit()
+    cur.close()
+    connection.protocol.reload_plot(plot_id)
+    connection.protocol.notify_player("You can now build in plot #%s" % plot_id, player)
+    connection.protocol.notify_admins("%s shared plot #%s with %s" % (connection.name, plot_id, player))
+    return "Player %s now can build in that plot" % player
+
+@command()
+def plotunshare(connection, plot_id, *player):
+    """
+    Remove access to a plot for a player
+    /plotunshare <#id> <player>
+    """
+    if not connection.logged_in:
+        return "Log in using /login to make changes to your plot"
+    plot_id = get_plot_arg(connection, plot_id)
+    if plot_id is None:
+        return "Plot not found"
+    if connection.protocol.plots[plot_id][4].lower() != connection.name.lower() and not connection.admin:
+        return "You can only manage your plots"
+    player = ' '.join(player)
+    cur = con.cursor()
+    cur.execute('DELETE FROM plot_shared WHERE plot = ? AND player = ?', (plot_id, player))
+    con.commit()
+    cur.close()
+    connection.protocol.reload_plot(plot_id)
+    connection.protocol.notify_player("You can no longer build in plot #%s" % plot_id, player)
+    connection.protocol.notify_admins("%s unshared plot #%s for %s" % (connection.name, plot_id, player))
+    return "Player %s no longer can build in that plot" % player
+
+@command()
+def plots(connection, *player):
+    """
+    List plots of a player
+    /plots <player> - your plots if omitted
+    """
+    player = ' '.join(player) or connection.name
+    owned = ['#%s %s,%s-%s,%s' % ((plot_id,) + tuple(x[:4])) for plot_id, x in sorted(connection.protocol.plots.items()) if x[4].lower() == player.lower()]
+    shared = ['#%s <%s>' % (plot_id, x[4]) for plot_id, x in sorted(connection.protocol.plots.items()) if player.lower() in x[5]]
+    connection.send_chat("Shared plots: " + (', '.join(shared) or 'none'))
+    connection.send_chat("Plots: " + (', '.join(owned) or 'none'))
+
 def build(con, x, y, z, color=None):
     block_action = BlockAction()
     block_action.player_id = 32
@@ -555,75 +766,174 @@ def apply_script(protocol, connection, config):
 
         def __init__(self, *arg, **kw):
             protocol.__init__(self, *arg, **kw)
+            self.load_claims()
+            self.load_plots()
+            self.update_spawn_candidates()
             self.sector_names_interval = 0.2
             self.sector_names_loop = LoopingCall(self.display_notifications)
             self.sector_names_loop.start(self.sector_names_interval)
 
         def display_notifications(self):
+            # Only players whose position or orientation changed since the last run are checked
             for player in self.players.values():
                 if not player.world_object:
-                    return
-                x, y, z = player.get_location()
-                if player.current_sector != get_sector(x, y):
-                    cur = con.cursor()
-                    res = cur.execute('SELECT name, mode, fog FROM claims WHERE sector = ?', (get_sector(x, y),)).fetchone()
-                    cur.close()
-                    fog = tuple(self.fog_color)
-                    player.quest_mode = False
-                    if res:
-                        name, mode, fog_db = res
-                        if fog_db:
-                            fog = hex2rgb(fog_db)
-                        if name:
-                            player.send_cmsg("Welcome to %s" % name, 'Status')
-                        if mode == 'quest':
-                            player.quest_mode = True
-                    player.sector_fog_transition(fog)
-                    player.current_sector = get_sector(x, y)
-                block = player.world_object.cast_ray(32)
-                if block:
-                    block = tuple(block)
-                if block in SIGNS:
-                    if player.current_sign:
-                        text, color, sign_block = player.current_sign
-                        if block == sign_block:
-                            player.send_cmsg(text, 'Notice')
-                            return
-                        else:
-                            text, color, sign_block = player.current_sign
-                            build(player, *sign_block, color)
-                            player.current_sign = None
-                            player.send_cmsg('\0', 'Notice')
-                    x, y, z = block
-                    cur = con.cursor()
-                    text = cur.execute('SELECT text FROM signs WHERE x = ? AND y = ? AND z = ?', (x, y, z)).fetchone()
-                    cur.close()
-                    if text:
-                        player.current_sign = (text[0], self.world.map.get_color(x, y, z), block)
-                        player.send_cmsg(text[0], 'Notice')
-                        build(player, x, y, z, None)
-                        build(player, x, y, z, (255, 255, 0))
-                else:
-                    if player.current_sign:
-                        text, color, sign_block = player.current_sign
-                        build(player, *sign_block, color)
-                        player.current_sign = None
-                        player.send_cmsg('\0', 'Notice')
+                    continue
+                if player.view_changed:
+                    player.view_changed = False
+                    player.update_notifications()
+                elif player.current_sign:
+                    player.resend_sign_notice()
+
+        def load_claims(self):
+            # One slot per sector: None for unclaimed, otherwise [owner, mode, set of lowercase shared names, name, fog].
+            # build_masks maps lowercase player names to a bitmask of sectors they own or were shared
+            self.claims = [None] * 64
+            self.build_masks = {}
+            cur = con.cursor()
+            for sector, owner, mode, name, fog in cur.execute('SELECT sector, owner, mode, name, fog FROM claims').fetchall():
+                self.claims[sector_index(sector)] = [owner, mode, set(), name, fog]
+            for sector, player in cur.execute('SELECT sector, player FROM shared').fetchall():
+                if self.claims[sector_index(sector)] and player:
+                    self.claims[sector_index(sector)][2].add(player.lower())
+            cur.close()
+            for i in range(64):
+                self.update_build_masks(i, True)
 
-        def is_claimed(self, x, y, z):
+        def reload_claim(self, sector):
+            i = sector_index(sector)
+            self.update_build_masks(i, False)
             cur = con.cursor()
-            claimed = cur.execute('SELECT sector, owner, mode FROM claims').fetchall()
+            res = cur.execute('SELECT owner, mode, name, fog FROM claims WHERE sector = ?', (sector,)).fetchone()
+            shared = cur.execute('SELECT player FROM shared WHERE sector = ?', (sector,)).fetchall()
             cur.close()
-            for sector, owner, mode in claimed:
-                sx, sy = coordinates(sector)
-                if x >= sx and y >= sy and x < sx + 64 and y < sy + 64:
-                    cur = con.cursor()
-                    shared = cur.execute('SELECT player FROM shared WHERE sector = ?', (sector,)).fetchall()
-                    cur.close()
-                    if shared:
-                        shared = [x[0] for x in shared]
-                    owners = [owner] + shared
-                    return owners, mode
+            if res:
+                owner, mode, name, fog = res
+                self.claims[i] = [owner, mode, set([x[0].lower() for x in shared if x[0]]), name, fog]
+            else:
+                self.claims[i] = None
+            self.update_build_masks(i, True)
+            self.revoke_build_grants(1 << i)
+            self.update_spawn_candidates()
+
+        def revoke_build_grants(self, mask):
+            # Bulk build grants are re-checked after any change to the sectors
+            for player in self.players.values():
+                if player.build_grant:
+                    player.build_grant = (player.build_grant[0] & ~mask,) + player.build_grant[1:]
+
+        def load_plots(self):
+            # plots maps id -> [x1, y1, x2, y2, owner, set of lowercase shared names] with inclusive corners.
+            # plot_grid lists the ids of plots overlapping each PLOT_CELL sized cell, so lookups only test a few rectangles
+            self.plots = {}
+            self.plot_grid = [[] for i in range(PLOT_GRID * PLOT_GRID)]
+            cur = con.cursor()
+            for plot_id, x1, y1, x2, y2, owner in cur.execute('SELECT id, x1, y1, x2, y2, owner FROM plots').fetchall():
+                self.plots[plot_id] = [x1, y1, x2, y2, owner, set()]
+            for plot_id, player in cur.execute('SELECT plot, player FROM plot_shared').fetchall():
+                if plot_id in self.plots and player:
+                    self.plots[plot_id][5].add(player.lower())
+            cur.close()
+            for plot_id, (x1, y1, x2, y2, owner, shared) in self.plots.items():
+                for cell in plot_cells(x1, y1, x2, y2):
+                    self.plot_grid[cell].append(plot_id)
+
+        def reload_plot(self, plot_id):
+            old = self.plots.pop(plot_id, None)
+            if old:
+                for cell in plot_cells(*old[:4]):
+                    self.plot_grid[cell].remove(plot_id)
+            cur = con.cursor()
+            res = cur.execute('SELECT x1, y1, x2, y2, owner FROM plots WHERE id = ?', (plot_id,)).fetchone()
+            shared = cur.execute('SELECT player FROM plot_shared WHERE plot = ?', (plot_id,)).fetchall()
+            cur.close()
+            if res:
+                self.plots[plot_id] = list(res) + [set([x[0].lower() for x in shared if x[0]])]
+                for cell in plot_cells(*res[:4]):
+                    self.plot_grid[cell].append(plot_id)
+            # New plots, plots moved into a sector and unshared plots are re-checked against grants held there
+            self.revoke_build_grants((area_sectors(*old[:4]) if old else 0) | (area_sectors(*res[:4]) if res else 0))
+            self.update_spawn_candidates()
+
+        def update_spawn_candidates(self):
+            # Spawn sectors and plots by lowercase player name, rebuilt from memory after every claim or plot change
+            self.owned_sectors = {}
+            self.shared_spawn_sectors = {}
+            self.owned_plots = {}
+            self.unclaimed_sectors = []
+            self.public_sectors = []
+            for i, claim in enumerate(self.claims):
+                if not claim:
+                    self.unclaimed_sectors.append(ALL_SECTORS[i])
+                    continue
+                owner, mode, shared, name, fog = claim
+                if owner:
+                    self.owned_sectors.setdefault(owner.lower(), []).append(ALL_SECTORS[i])
+                for player in shared:
+                    self.shared_spawn_sectors.setdefault(player, []).append(ALL_SECTORS[i])
+                if mode == 'public':
+                    self.public_sectors.append(ALL_SECTORS[i])
+            for x1, y1, x2, y2, owner, shared in self.plots.values():
+                self.owned_plots.setdefault(owner.lower(), []).append((x1, y1, x2, y2))
+
+        def update_spawn_positions(self):
+            # A few random columns per sector, preferring ones above water level. z is re-read on spawn since the map changes
+            self.spawn_positions = []
+            for i in range(64):
+                sx, sy = coordinates(ALL_SECTORS[i])
+                columns = []
+                for n in range(SPAWN_SAMPLES):
+                    x, y = sx + random.randrange(64), sy + random.randrange(64)
+                    columns.append((x, y, self.map.get_z(x, y)))
+                self.spawn_positions.append([c for c in columns if c[2] < 63] or columns)
+
+        def get_sector_spawn(self, sector):
+            x, y, z = random.choice(self.spawn_positions[sector_index(sector)])
+            return (x, y, self.map.get_z(x, y))
+
+        def on_map_change(self, map):
+            protocol.on_map_change(self, map)
+            self.update_spawn_positions()
+
+        def get_plot(self, x, y):
+            if not (0 <= x < 512 and 0 <= y < 512):
+                return None
+            for plot_id in self.plot_grid[int(x) // PLOT_CELL * PLOT_GRID + int(y) // PLOT_CELL]:
+                x1, y1, x2, y2 = self.plots[plot_id][:4]
+                if x1 <= x < x2 + 1 and y1 <= y < y2 + 1:
+                    return plot_id
+            return None
+
+        def plots_in_area(self, x1, y1, x2, y2):
+            # Ids of plots overlapping a box with inclusive corners
+            found = set()
+            for cell in plot_cells(max(x1, 0), max(y1, 0), min(x2, 511), min(y2, 511)):
+                for plot_id in self.plot_grid[cell]:
+                    px1, py1, px2, py2 = self.plots[plot_id][:4]
+                    if px1 <= x2 and x1 <= px2 and py1 <= y2 and y1 <= py2:
+                        found.add(plot_id)
+            return found
+
+        def update_build_masks(self, i, value):
+            claim = self.claims[i]
+            if not claim:
+                return
+            owner, mode, shared, name, fog = claim
+            names = set(shared)
+            if owner:
+                names.add(owner.lower())
+            for name in names:
+                if value:
+                    self.build_masks[name] = self.build_masks.get(name, 0) | 1 << i
+                else:
+                    self.build_masks[name] = self.build_masks.get(name, 0) & ~(1 << i)
+
+        def is_claimed(self, x, y, z):
+            if not (0 <= x < 512 and 0 <= y < 512):
+                return False, None
+            claim = self.claims[int(x) // 64 * 8 + int(y) // 64]
+            if claim:
+                owner, mode, shared, name, fog = claim
+                return [owner] + list(shared), mode
             return False, None
 
     class ClaimsConnection(connection):
@@ -633,80 +943,198 @@ def apply_script(protocol, connection, config):
             self.current_sector = None
             self.shared_sectors = None
             self.current_sign = None
+            self.view_changed = False
+            self.last_view = None
             self.quest_mode = False
             self.sfog_a = self.protocol.fog_color
-            self.sfog_b = None
-            self.sfog_step = None
-            self.sfog_loop = None
+            # (sector bitmask, holder, holder attribute) from the last successful bulk check, see check_build_sectors
+            self.build_grant = None
+
+        def on_disconnect(self):
+            self.release_build_grant()
+            return connection.on_disconnect(self)
+
+        def on_position_update(self):
+            self.view_changed = True
+            return connection.on_position_update(self)
+
+        def on_orientation_update(self, x, y, z):
+            self.view_changed = True
+            return connection.on_orientation_update(self, x, y, z)
+
+        def update_notifications(self):
+            x, y, z = self.world_object.position.get()
+            if not (0 <= x < 512 and 0 <= y < 512):
+                return
+            sector = get_sector(x, y)
+            if self.current_sector != sector:
+                fog = tuple(self.protocol.fog_color)
+                self.quest_mode = False
+                claim = self.protocol.claims[sector_index(sector)]
+                if claim:
+                    owner, mode, shared, name, fog_hex = claim
+                    if fog_hex:
+                        fog = hex2rgb(fog_hex)
+                    if name:
+                        self.send_cmsg("Welcome to %s" % name, 'Status')
+                    if mode == 'quest':
+                        self.quest_mode = True
+                self.sector_fog_transition(fog)
+                self.current_sector = sector
+            orientation = self.world_object.orientation.get()
+            view = (int(x), int(y), int(z)) + tuple(round(v, 2) for v in orientation)
+            if view == self.last_view:
+                if self.current_sign:
+                    self.resend_sign_notice()
+                return
+            self.last_view = view
+            block = self.world_object.cast_ray(32)
+            if block:
+                block = tuple(block)
+            if self.current_sign:
+                text, color, sign_block = self.current_sign
+                if block == sign_block:
+                    self.send_cmsg(text, 'Notice')
+                    return
+                build(self, *sign_block, color)
+                self.current_sign = None
+                self.send_cmsg('\0', 'Notice')
+            text = SIGNS.get(block)
+            if text:
+                x, y, z = block
+                self.current_sign = (text, self.protocol.world.map.get_color(x, y, z), block)
+                self.send_cmsg(text, 'Notice')
+                build(self, x, y, z, None)
+                build(self, x, y, z, (255, 255, 0))
+
+        def resend_sign_notice(self):
+            # Notices fade on the client, so the sign text is sent every tick while the player looks at it
+            self.send_cmsg(self.current_sign[0], 'Notice')
 
         def sector_fog_transition(self, color):
-            if self.sfog_loop:
-                self.sfog_loop.stop()
-            self.sfog_b = color
-            self.sfog_step = 1
-            self.sfog_loop = LoopingCall(self.update_sector_fog)
-            self.sfog_loop.start(0.05)
-
-        def update_sector_fog(self):
-            sfog_color = FogColor()
-            self.sfog_a = interpolate_rgb(self.sfog_a, self.sfog_b, self.sfog_step / 64)
-            sfog_color.color = make_color(*self.sfog_a)
-            self.send_contained(sfog_color)
-            if self.sfog_step == 64:
-                self.sfog_step = None
-                self.sfog_loop.stop()
-                self.sfog_loop = None
-            else:
-                self.sfog_step += 1
+            # Replaces the transition still running from a previous sector, starting from the color reached so far
+            self.protocol.start_tween((self, 'sector_fog'), self.update_sector_fog(color), 0.05)
+
+        def update_sector_fog(self, color):
+            for step in range(1, 65):
+                self.sfog_a = interpolate_rgb(self.sfog_a, color, step / 64)
+                self.send_fog_color(self.sfog_a)
+                yield
 
         def can_build(self, x, y, z):
             if self.god:
                 return True
-            owners, mode = self.protocol.is_claimed(x, y, z)
-            if owners:
+            if not (0 <= x < 512 and 0 <= y < 512):
+                return None
+            i = int(x) // 64 * 8 + int(y) // 64
+            claim = self.protocol.claims[i]
+            if not claim or claim[1] == 'public':
+                # Plots are only made in unclaimed and public sectors, and hold even against the sector's owner
+                plot_id = self.protocol.get_plot(x, y)
+                if plot_id is not None:
+                    if self.holds_plot(plot_id):
+                        return True
+                    self.send_chat("Plot #%s is claimed. If you want to build here, ask %s to /plotshare it with you" % (plot_id, self.protocol.plots[plot_id][4]))
+                    return False
+            if claim:
+                owner, mode, shared, name, fog = claim
                 if self.logged_in:
-                    if self.name.lower() in [x.lower() for x in owners if x]:
+                    if self.protocol.build_masks.get(self.name.lower(), 0) >> i & 1:
                         return True
                 if self.shared_sectors:
                     if get_sector(x, y) in self.shared_sectors:
                         return True
-                if mode == 'public':
-                    return None # Same as unclaimed sectors
-                if owners[0]:
-                    self.send_chat("Sector %s is claimed. If you want to build here, ask %s to /share it with you. You can also build in /free sectors" % (get_sector(x, y), owners[0]))
-                else:
-                    self.send_chat("Sector %s is reserved" % get_sector(x, y))
-                return False
+                if mode != 'public': # Public sectors are the same as unclaimed ones
+                    if owner:
+                        self.send_chat("Sector %s is claimed. If you want to build here, ask %s to /share it with you. You can also build in /free sectors" % (get_sector(x, y), owner))
+                    else:
+                        self.send_chat("Sector %s is reserved" % get_sector(x, y))
+                    return False
             return None # Returned for unclaimed sectors
 
+        def holds_plot(self, plot_id):
+            if not self.logged_in:
+                return False
+            plot_owner, plot_shared = self.protocol.plots[plot_id][4:]
+            return self.name.lower() == plot_owner.lower() or self.name.lower() in plot_shared
+
+        def permitted_sectors(self):
+            # Bitmask of sectors where can_build returns True
+            if self.god:
+                return (1 << 64) - 1
+            mask = 0
+            if self.logged_in:
+                mask = self.protocol.build_masks.get(self.name.lower(), 0)
+            for sector in self.shared_sectors or []:
+                if self.protocol.claims[sector_index(sector)]:
+                    mask |= 1 << sector_index(sector)
+            for i in range(64):
+                # Public sectors with other players' plots are checked block by block
+                if mask >> i & 1 and self.protocol.claims[i][1] == 'public':
+                    x, y = i // 8 * 64, i % 8 * 64
+                    if not all(self.holds_plot(plot_id) for plot_id in self.protocol.plots_in_area(x, y, x + 63, y + 63)):
+                        mask &= ~(1 << i)
+            return mask
+
+        def check_build_sectors(self, mask, holder=None, holder_attr='state'):
+            """
+            Check a whole set of sectors at once. Returns (sector names, allowed), where allowed means build commands may be used in all of them.
+            Allowed sectors are granted: per-block claim checks inside them are skipped until release_build_grant() is called,
+            or, if a holder is given, until self.<holder_attr> is no longer that holder. Without a holder, the caller has to release
+            the grant before returning. A failed check drops the previous grant
+            """
+            allowed = mask & ~self.permitted_sectors() == 0
+            self.build_grant = (mask, holder, holder_attr) if allowed else None
+            return mask_sectors(mask), allowed
+
+        def check_build_area(self, x1, y1, x2, y2, holder=None, holder_attr='state'):
+            sectors, allowed = self.check_build_sectors(area_sectors(x1, y1, x2, y2), holder, holder_attr)
+            if not allowed and self.logged_in:
+                # A box within one of the player's plots is allowed too, but not granted since only part of the sector is
+                plot_id = self.protocol.get_plot(x1, y1)
+                if plot_id is not None and plot_id == self.protocol.get_plot(x2, y2):
+                    allowed = self.holds_plot(plot_id)
+            return sectors, allowed
+
+        def check_build_points(self, points, holder=None, holder_attr='state'):
+            return self.check_build_sectors(points_sectors(points), holder, holder_attr)
+
+        def release_build_grant(self):
+            self.build_grant = None
+
+        def granted_sectors(self):
+            if not self.build_grant:
+                return 0
+            mask, holder, holder_attr = self.build_grant
+            if holder is not None and getattr(self, holder_attr, None) is not holder:
+                self.build_grant = None
+                return 0
+            return mask
+
         def on_block_destroy(self, x, y, z, value):
             if connection.on_block_destroy(self, x, y, z, value) == False:
                 return False
-            if self.can_build(x, y, z) == False:
-                return False
-
-            if self.sculpting or self.sel_a: # /sculpt and creativetools.py
-                if self.can_build(x, y, z) != True:
-                    self.send_chat("Build commands can only be used in your sectors")
-                    return False
-            if self.state: # CBC compatibility. Limits usage to sectors players have access to
-                if type(self.state).__name__ == 'GradientState': # exception
-                    return
-                if self.can_build(x, y, z) != True:
-                    self.send_chat("Build commands can only be used in your sectors")
-                    return False
-                if '_choosing' in dir(self.state):
-                    if self.state._choosing == 1:
-                        if self.can_build(x, self.state._first_point.y, z) != True or self.can_build(self.state._first_point.x, y, z) != True:
-                            self.send_chat("Build commands can only affect blocks within your sectors")
-                            return False
-                        if abs(x - self.state._first_point.x) > 64 or abs(y - self.state._first_point.y) > 64:
-                            self.send_chat("Build commands are limited to 64 blocks")
-                            return False
+            return self.check_block_claims(x, y, z)
 
         def on_block_build_attempt(self, x, y, z):
             if connection.on_block_build_attempt(self, x, y, z) == False:
                 return False
+            return self.check_block_claims(x, y, z)
+
+        def check_block_claims(self, x, y, z):
+            grant = self.granted_sectors()
+            if grant and 0 <= x < 512 and 0 <= y < 512 and grant >> (int(x) // 64 * 8 + int(y) // 64) & 1:
+                first_point = None
+                if getattr(self.state, '_choosing', None) == 1 and type(self.state).__name__ != 'GradientState':
+                    first_point = self.state._first_point
+                if first_point is None:
+                    return
+                if area_sectors(x, y, first_point.x, first_point.y) & ~grant == 0:
+                    if abs(x - first_point.x) > 64 or abs(y - first_point.y) > 64:
+                        self.send_chat("Build commands are limited to 64 blocks")
+                        return False
+                    return
+
             if self.can_build(x, y, z) == False:
                 return False
 
@@ -714,20 +1142,21 @@ def apply_script(protocol, connection, config):
                 if self.can_build(x, y, z) != True:
                     self.send_chat("Build commands can only be used in your sectors")
                     return False
-            if self.state:
-                if type(self.state).__name__ == 'GradientState':
+            if self.state: # CBC compatibility. Limits usage to sectors players have access to
+                if type(self.state).__name__ == 'GradientState': # exception
                     return
                 if self.can_build(x, y, z) != True:
                     self.send_chat("Build commands can only be used in your sectors")
                     return False
-                if '_choosing' in dir(self.state):
-                    if self.state._choosing == 1:
-                        if self.can_build(x, self.state._first_point.y, z) != True or self.can_build(self.state._first_point.x, y, z) != True:
-                            self.send_chat("Build commands can only affect blocks within your sectors")
-                            return False
-                        if abs(x - self.state._first_point.x) > 64 or abs(y - self.state._first_point.y) > 64:
-                            self.send_chat("Build commands are limited to 64 blocks")
-                            return False
+                if getattr(self.state, '_choosing', None) == 1:
+                    first_point = self.state._first_point
+                    # One check for every sector between the corners; on success the rest of the command skips per-block checks
+                    if not self.check_build_area(x, y, first_point.x, first_point.y, self.state)[1]:
+                        self.send_chat("Build commands can only affect blocks within your sectors")
+                        return False
+                    if abs(x - first_point.x) > 64 or abs(y - first_point.y) > 64:
+                        self.send_chat("Build commands are limited to 64 blocks")
+                        return False
 
         def on_line_build_attempt(self, points):
             if connection.on_line_build_attempt(self, points) == False:
@@ -737,36 +1166,30 @@ def apply_script(protocol, connection, config):
                     return False
 
         def on_spawn(self, pos):
+            self.view_changed = True
+            self.last_view = None
             self.protocol.sector_names_loop.stop()
             self.protocol.sector_names_loop = LoopingCall(self.protocol.display_notifications)
             self.protocol.sector_names_loop.start(self.protocol.sector_names_interval)
             return connection.on_spawn(self, pos)
 
         def get_spawn_location(self):
+            # Everything comes from the candidate lists kept by the protocol, no queries on respawn
+            protocol = self.protocol
             try:
                 if self.current_sector:
-                    spawn_sector = self.current_sector
-                else:
-                    cur = con.cursor()
-                    my_sectors = [x[0] for x in cur.execute('SELECT sector FROM claims WHERE owner = ?', (self.name,)).fetchall()]
-                    if my_sectors:
-                        spawn_sector = random.choice(my_sectors)
-                    else:
-                        shared_sectors = [x[0] for x in cur.execute('SELECT sector FROM shared WHERE player = ?', (self.name,)).fetchall()]
-                        if shared_sectors:
-                            spawn_sector = random.choice(shared_sectors)
-                        else:
-                            claimed_sectors = [x[0] for x in cur.execute('SELECT sector FROM claims').fetchall()]
-                            unclaimed_sectors = [x for x in ALL_SECTORS if x not in claimed_sectors]
-                            if unclaimed_sectors:
-                                spawn_sector = random.choice(unclaimed_sectors)
-                            else:
-                                public_sectors = [x[0] for x in cur.execute('SELECT sector FROM claims WHERE mode = "public"').fetchall()]
-                                if public_sectors:
-                                    spawn_sector = random.choice(public_sectors)
-                                else:
-                                    spawn_sector = random.choice(ALL_SECTORS)
-                    cur.close()
+                    return protocol.get_sector_spawn(self.current_sector)
+                name = (self.name or '').lower()
+                if protocol.owned_sectors.get(name):
+                    return protocol.get_sector_spawn(random.choice(protocol.owned_sectors[name]))
+                if self.logged_in and protocol.owned_plots.get(name):
+                    x1, y1, x2, y2 = random.choice(protocol.owned_plots[name])
+                    sx, sy = random.randint(x1, x2), random.randint(y1, y2)
+                    return (sx, sy, protocol.map.get_z(sx, sy))
+                for sectors in (protocol.shared_spawn_sectors.get(name), protocol.unclaimed_sectors, protocol.public_sectors):
+                    if sectors:
+                        return protocol.get_sector_spawn(random.choice(sectors))
+                return protocol.get_sector_spawn(random.choice(ALL_SECTORS))
             except:
                 spawn_sector = random.choice(ALL_SECTORS)
 
@@ -380,6 +380,8 @@ def apply_script(protocol, connection, config):
                             block_action.z = z
                             block_action.value = BUILD_BLOCK
                             self.protocol.map.set_point(x, y, z, self.color)
+                            if hasattr(self.protocol, 'mark_dirty'): # rollback.py
+                                self.protocol.mark_dirty(x, y)
                             self.protocol.broadcast_contained(block_action, save=True)
                             connection.on_block_build(self, int(x), int(y), int(z))
                 if CHAIR_ENABLED:
@@ -72,6 +72,8 @@ def build(con, x, y, z, color=None):
     else:
         block_action.value = DESTROY_BLOCK
         con.protocol.map.remove_point(x, y, z)
+    if hasattr(con.protocol, 'mark_dirty'): # rollback.py
+        con.protocol.mark_dirty(x, y)
     con.protocol.broadcast_contained(block_action, save=True)
 
 def queue(con, x, y, z, color=False, save_history=True):
@@ -919,9 +921,16 @@ def apply_script(protocol, connection, config):
                 return False
 
         def build_queue_start(self):
-            self.build_queue_len = len(self.build_queue)
+            if self.build_queue_loop and self.build_queue_loop.running: # replaced by the new queue
+                self.build_queue_loop.stop()
+            if hasattr(self, 'release_build_grant'): # claims.py
+                self.release_build_grant()
+            blocks = self.build_queue
+            self.build_queue_len = len(blocks)
 ##            self.build_queue = sorted(self.build_queue, key=lambda x: (x[3] is not None, x[3])) # blocks queued for removal should be processed first
-            self.build_queue = iter(self.build_queue)
+            self.build_queue = iter(blocks)
+            if hasattr(self, 'check_build_points'): # claims.py. Skips per-block claim checks if every touched sector is permitted, while this queue runs
+                self.check_build_points(blocks, self.build_queue, 'build_queue')
             self.build_queue_loop = LoopingCall(self.build_queue_batch)
             self.build_queue_loop.start(0.01)
 
@@ -933,12 +942,16 @@ def apply_script(protocol, connection, config):
                         if build(self, *block) == False:
                             self.build_queue_loop.stop()
                             self.build_queue = []
+                            if hasattr(self, 'release_build_grant'): # claims.py
+                                self.release_build_grant()
                             if not self.brush:
                                 self.send_chat('%s block(s) have been changed' % self.build_queue_len)
                             break
                 except StopIteration:
                     self.build_queue_loop.stop()
                     self.build_queue = []
+                    if hasattr(self, 'release_build_grant'): # claims.py
+                        self.release_build_grant()
                     if not self.brush:
                         self.send_chat('%s block(s) have been changed' % self.build_queue_len)
                     break
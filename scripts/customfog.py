@@ -2,6 +2,8 @@
 Cycle through different fog colors
 Photosensitivity warning! Please exercise caution with contrast colors, especially if loop interval is under 1s
 
+Requires fogtween.py
+
 Commands
 ^^^^^^^^
 
@@ -14,7 +16,6 @@ Commands
 """
 
 from random import choices
-from twisted.internet.task import LoopingCall
 from piqueserver.commands import command
 from pyspades.color import interpolate_hsb, interpolate_rgb, hsb_to_rgb
 
@@ -104,9 +105,10 @@ def apply_script(protocol, connection, config):
         fog_interval = None
         fog_n = 0
 
-        def __init__(self, *arg, **kw):
-            protocol.__init__(self, *arg, **kw)
-            self.fog_loop = LoopingCall(self.update_fog_color)
+        def fog_cycle(self):
+            while True:
+                self.update_fog_color()
+                yield
 
         def update_fog_color(self):
             if self.is_fog_smooth:
@@ -141,12 +143,12 @@ def apply_script(protocol, connection, config):
                         choices(range(256), k=3),
                         choices(range(256), k=3)
                         ]
-                self.fog_loop.start(0.1)
+                self.start_tween('customfog', self.fog_cycle(), 0.1)
             else:
-                self.fog_loop.start(interval)
+                self.start_tween('customfog', self.fog_cycle(), interval)
 
         def stop_fog_cycle(self):
-            self.fog_loop.stop()
+            self.stop_tween('customfog')
             self.is_fog_active = False
             self.is_fog_smooth = False
             self.set_fog_color(self.original_fog_color)
@@ -75,6 +75,8 @@ def build(con, x, y, z):
     block_action.value = BUILD_BLOCK
     con.protocol.broadcast_contained(block_action, save=True)
     con.protocol.map.set_point(x, y, z, con.color)
+    if hasattr(con.protocol, 'mark_dirty'): # rollback.py
+        con.protocol.mark_dirty(x, y)
 
 
 def apply_script(protocol, connection, config):
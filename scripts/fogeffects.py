@@ -2,12 +2,11 @@
 # All other copyrights are held jointly by collaborators from the aloha.pk community.
 # This file is a redistribution by the aloha.pk organization. More information: https://aloha.pk/pub/github-org
 
-from twisted.internet.task import LoopingCall
+# Requires fogtween.py
+
 from twisted.internet.reactor import callLater, seconds
 from pyspades.color import interpolate_rgb
 from pyspades import contained as loaders
-fog_color = loaders.FogColor()
-from pyspades.common import make_color
 from piqueserver.commands import command, get_player
 
 S_SPECTATING = "{player} is spectating"
@@ -111,11 +110,9 @@ class FogEffect:
     def release(self):
         self.protocol.fog_effects.remove(self)
     
-    def send_fog(self, sender = None):
-        sender = sender or self.protocol
-        color = self.get_color()
-        fog_color.color = make_color(*color)
-        sender.broadcast_contained(fog_color, save = True)
+    def send_fog(self):
+        # fogtween.py skips players that already have this color
+        self.protocol.broadcast_fog_color(self.get_color())
 
 class FogHold(FogEffect):
     def __init__(self, duration, color):
@@ -160,13 +157,14 @@ class FogGradient(FogEffect):
         self.begin = wrap_if_necessary(begin)
         self.end = wrap_if_necessary(end)
         self.interpolator = interpolator
-        self.loop = LoopingCall(self.apply)
+        self.running = False
         self.complete = False
     
     def start(self):
-        if not self.loop.running:
+        if not self.running:
+            self.running = True
             self.final_time = seconds() + self.duration
-            self.loop.start(FOG_INTERVAL, now = True)
+            self.protocol.start_tween(self, self.apply(), FOG_INTERVAL)
     
     def get_color(self):
         t = 1.0 - (self.final_time - seconds()) / self.duration
@@ -175,17 +173,17 @@ class FogGradient(FogEffect):
     
     def apply(self):
         fog_effects = self.protocol.fog_effects
-        if self.complete:
-            self.done()
-            return
-        if fog_effects[-1] is self:
-            self.send_fog()
-        self.complete = seconds() >= self.final_time
+        while not self.complete:
+            if fog_effects[-1] is self:
+                self.send_fog()
+            self.complete = seconds() >= self.final_time
+            yield
+        self.done()
     
     def release(self):
-        if self.loop.running:
-            self.loop.stop()
-        self.loop = None
+        if self.running:
+            self.protocol.stop_tween(self)
+            self.running = False
         FogEffect.release(self)
 
 def apply_script(protocol, connection, config):
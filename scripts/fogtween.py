@@ -0,0 +1,150 @@
+"""
+Shared scheduler for fog and color animations
+
+Every running tween is advanced from one protocol-wide timer instead of a LoopingCall per effect or per player.
+A tween is a generator that does one step of work each time it is resumed and stops when it returns.
+Starting a tween under a key that is already running closes the old one first.
+
+Fog colors are rounded to whole RGB values and only sent to players whose last received fog color differs.
+List this script before the scripts that use it (claims.py, customfog.py, fogeffects.py, teamcolor.py).
+
+Options
+^^^^^^^
+
+.. code-block:: toml
+
+    [fogtween]
+    interval = 0.05 # seconds between scheduler ticks
+
+.. codeauthor:: Liza
+"""
+
+from twisted.internet.reactor import seconds
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+from piqueserver.config import config
+from pyspades.common import make_color
+from pyspades.contained import FogColor
+
+
+tween_config = config.section('fogtween')
+tween_interval = tween_config.option('interval', 0.05)
+
+log = Logger()
+
+
+def quantize_color(color):
+    return tuple(int(round(c)) for c in color)
+
+
+def apply_script(protocol, connection, config):
+    class FogTweenProtocol(protocol):
+        def __init__(self, *arg, **kw):
+            protocol.__init__(self, *arg, **kw)
+            # Maps key -> [generator, interval, next due time]
+            self.tweens = {}
+            self.tween_interval = float(tween_interval.get())
+            self.tween_loop = LoopingCall(self.update_tweens)
+
+        def start_tween(self, key, tween, interval=None):
+            """
+            Run generator `tween` once now and then every `interval` seconds until it is exhausted.
+            Any tween already running under `key` is cancelled
+            """
+            self.stop_tween(key)
+            now = seconds()
+            entry = [tween, interval or self.tween_interval, now]
+            self.tweens[key] = entry
+            self.step_tween(key, entry, now)
+            if self.tweens and not self.tween_loop.running:
+                self.tween_loop.start(self.tween_interval, now=False)
+
+        def stop_tween(self, key):
+            entry = self.tweens.pop(key, None)
+            if entry and not entry[0].gi_running:
+                entry[0].close()
+
+        def stop_tweens(self, owner):
+            # Player-bound tweens use (connection, name) keys
+            for key in list(self.tweens):
+                if isinstance(key, tuple) and key[0] is owner:
+                    self.stop_tween(key)
+
+        def is_tween_running(self, key):
+            return key in self.tweens
+
+        def step_tween(self, key, entry, now):
+            tween, interval, due = entry
+            entry[2] = max(due + interval, now)
+            try:
+                next(tween)
+            except StopIteration:
+                if self.tweens.get(key) is entry:
+                    del self.tweens[key]
+            except Exception:
+                log.failure('Tween {key!r} failed', key=key)
+                if self.tweens.get(key) is entry:
+                    del self.tweens[key]
+
+        def update_tweens(self):
+            now = seconds()
+            # Half a tick of slack so tweens slower than the scheduler don't slip by a whole tick
+            slack = self.tween_interval / 2
+            for key, entry in list(self.tweens.items()):
+                if self.tweens.get(key) is entry and entry[2] - slack <= now:
+                    self.step_tween(key, entry, now)
+            if not self.tweens and self.tween_loop.running:
+                self.tween_loop.stop()
+
+        def broadcast_fog_color(self, color):
+            # Like broadcast_contained(save=True), but skips players that already see this color
+            color = quantize_color(color)
+
+            def changed(player):
+                if player.sent_fog_color == color:
+                    return False
+                player.sent_fog_color = color
+                return True
+
+            fog_color = FogColor()
+            fog_color.color = make_color(*color)
+            self.broadcast_contained(fog_color, save=True, rule=changed)
+
+        def set_fog_color(self, color):
+            self.fog_color = color
+            self.broadcast_fog_color(color)
+
+        def on_map_change(self, map):
+            # Clients get the fog color again with the new map's state data
+            for player in self.players.values():
+                player.sent_fog_color = None
+            protocol.on_map_change(self, map)
+
+        def on_map_leave(self):
+            # Per-player fog would reach clients in the middle of the map transfer. Protocol-wide cycles
+            # (customfog, teamcolor) keep running across maps like their own timers used to, and fogeffects
+            # releases its gradients itself
+            for player in self.players.values():
+                self.stop_tweens(player)
+            protocol.on_map_leave(self)
+
+    class FogTweenConnection(connection):
+        def __init__(self, *arg, **kw):
+            connection.__init__(self, *arg, **kw)
+            # Fog color this client was last sent; None until known
+            self.sent_fog_color = None
+
+        def send_fog_color(self, color):
+            color = quantize_color(color)
+            if self.sent_fog_color == color:
+                return
+            self.sent_fog_color = color
+            fog_color = FogColor()
+            fog_color.color = make_color(*color)
+            self.send_contained(fog_color)
+
+        def on_disconnect(self):
+            self.protocol.stop_tweens(self)
+            return connection.on_disconnect(self)
+
+    return FogTweenProtocol, FogTweenConnection
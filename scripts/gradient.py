@@ -66,6 +66,8 @@ def build_gradient_line(protocol, colors, points):
         color = tuple(int(round(sum(c*p for c, p in zip(crng, pct)))) for crng in color_range)
 
         map_.set_point(*points[i], color=color)
+        if hasattr(protocol, 'mark_dirty'): # rollback.py
+            protocol.mark_dirty(points[i][0], points[i][1])
         
         set_color.value = make_color(*color)
         protocol.broadcast_contained(set_color, save=True)
@@ -87,6 +87,8 @@ def processvoxels(protocol, map, is_forced, is_emote):
     block_action.player_id = 33
     if not is_emote:
         map.set_point(p[0], p[1], zee, RGB)
+        if hasattr(protocol, 'mark_dirty'): # rollback.py
+            protocol.mark_dirty(p[0], p[1])
     block_action.x = p[0]
     block_action.y = p[1]
     block_action.z = zee
@@ -222,6 +222,8 @@ def build_block(connection, x, y, z, color):
     block_action.z = z
     block_action.value = BUILD_BLOCK
     connection.protocol.map.set_point(x, y, z, color)
+    if hasattr(connection.protocol, 'mark_dirty'): # rollback.py
+        connection.protocol.mark_dirty(x, y)
     connection.protocol.broadcast_contained(block_action, save=True)
 
 
@@ -233,10 +235,15 @@ def destroy_block(connection, x, y, z):
         block_action.y = y
         block_action.z = z
         block_action.value = DESTROY_BLOCK
+        count = 1
         if z == 62:
             connection.protocol.map.remove_point(x, y, z)
         else:
-            connection.protocol.map.destroy_point(x, y, z)
+            count = connection.protocol.map.destroy_point(x, y, z)
+        if hasattr(connection.protocol, 'mark_dirty'): # rollback.py
+            connection.protocol.mark_dirty(x, y)
+            if count > 1:
+                connection.protocol.mark_collapse()
         connection.protocol.broadcast_contained(block_action, save=True)
 
 
@@ -284,6 +291,7 @@ def rollout_multiblocks(self, coord, destroy=False):
     last_clr = self.regblocks[-1][-1]
     if last_clr != self.color:
         self.regblocks = [(x, y, z, dir, self.color) if clr == last_clr else (x, y, z, dir, clr) for x, y, z, dir, clr in self.regblocks]
+    blocks = []
     for regblock in reversed(self.regblocks):
         if first:
             first = False
@@ -292,7 +300,13 @@ def rollout_multiblocks(self, coord, destroy=False):
         mb_x = regblock[0] + block_diff[0]
         mb_y = regblock[1] + block_diff[1]
         mb_z = regblock[2] + block_diff[2]
-        if is_invalid_coord(mb_x, mb_y, mb_z) or mb_z >= self.protect_ground or self.on_block_build_attempt(mb_x, mb_y, mb_z) == False:
+        if is_invalid_coord(mb_x, mb_y, mb_z) or mb_z >= self.protect_ground:
+            continue
+        blocks.append((mb_x, mb_y, mb_z, regblock))
+    if hasattr(self, 'check_build_points'): # claims.py. Skips per-block claim checks if every touched sector is permitted
+        self.check_build_points(blocks)
+    for mb_x, mb_y, mb_z, regblock in blocks:
+        if self.on_block_build_attempt(mb_x, mb_y, mb_z) == False:
             continue
         is_solid = self.protocol.map.get_solid(mb_x, mb_y, mb_z)
         if destroy and is_solid:
@@ -301,6 +315,8 @@ def rollout_multiblocks(self, coord, destroy=False):
         elif not destroy and not is_solid:
             callLater(delay, build_block, self, mb_x, mb_y, mb_z, regblock[-1])
             delay += BUILD_DELAY
+    if hasattr(self, 'release_build_grant'):
+        self.release_build_grant()
 
 
 def apply_script(protocol, connection, config):
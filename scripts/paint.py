@@ -39,6 +39,8 @@ def paint_block(protocol, player, x, y, z, color):
     if protocol.map.get_color(x, y, z) == color:
         return False
     protocol.map.set_point(x, y, z, color)
+    if hasattr(protocol, 'mark_dirty'): # rollback.py
+        protocol.mark_dirty(x, y)
     block_action = BlockAction()
     block_action.x = x
     block_action.y = y
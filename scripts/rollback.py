@@ -7,12 +7,40 @@ Commands
 
 * ``/rollmap <map name>`` changes the map to the given map in a rolling fashion *admin only*
 * ``/rollmap <map name> <current map sector> <new map sector>`` changes the sector of the current map to the given map's sector in a rolling fashion *admin only*
-* ``/rollback`` starts a rollback on the current map *admin only*
+* ``/rollback [sector] [snapshot]`` starts a rollback of the current map to the snapshot taken when it was loaded or the given one *admin only*
+* ``/rollmapsel <map name>`` and ``/rollbacksel [snapshot]`` do the same for the box selected with creativetools.py's ``/sel`` *admin only*
+* ``/rollmapdry`` and ``/rollbackdry`` take the same arguments and report what the rollback would change and cost *admin only*
 * ``/rollbackcancel`` cancel an on-going rollback *admin only*
+* ``/rollbackresume`` resumes a rollback interrupted by a map change or restart *admin only*
+* ``/snapshot <name>`` saves the current state of the map as a snapshot *admin only*
+* ``/snapshots`` lists snapshots with their memory use *admin only*
+* ``/dropsnapshot <name>`` deletes a snapshot *admin only*
 
 .. warning::
    ``/rollmap`` will take a long time if number of differing blocks is too high.
 
+The map diff is computed with NumPy when it is installed, otherwise voxel by voxel. With NumPy, sectors are
+diffed in a pool of ``diff_workers`` processes (0 uses all cores, 1 diffs in the server process) and sent as they finish.
+Maps loaded by ``/rollmap`` are kept parsed in an LRU of at most ``map_cache_size`` megabytes until their file changes.
+
+Snapshots keep the serialized columns of every sector, sharing sectors that did not change with the previous snapshot.
+The map is snapshotted as ``map`` when loaded and every ``snapshot_interval`` minutes (0 disables this). The oldest
+snapshots are dropped when they use more than ``snapshot_memory`` megabytes.
+
+Rollback progress is saved to ``rollback_checkpoint.json`` in the config directory every ``checkpoint_interval`` seconds,
+on shutdown and when the map changes. Resuming on the same map skips columns that were already rolled back, and after
+the map was loaded again (which loses the rollback's changes) starts over. With ``resume_on_load``, it resumes when its
+map is loaded again.
+
+With ``reload_ratio`` set, ``/rollback`` and ``/rollmap`` diff everything before sending anything, so they take longer
+to start. If sending the changes block by block would cost ``reload_ratio`` times more bytes than the map itself, they are
+applied at once and every client downloads the map again. Players have to rejoin their team, and are put back where they
+were. 0 (the default) disables this.
+Rollbacks to the original map only inspect columns changed since the map was loaded. Scripts that write to the map
+directly should call ``protocol.mark_dirty(x, y)`` when rollback.py is loaded, and ``protocol.mark_collapse()`` when
+``check_node``/``destroy_point`` removed floating blocks. Columns of collapsed blocks aren't known, so after a collapse
+these rollbacks scan their whole range until the next map is loaded.
+
 Options
 ^^^^^^^
 
@@ -20,16 +48,37 @@ Options
 
     [rollback]
     rollback_on_game_end = false
+    diff_workers = 0
+    map_cache_size = 300
+    snapshot_interval = 60
+    snapshot_memory = 200
+    checkpoint_interval = 30
+    resume_on_load = false
+    reload_ratio = 0
 
 .. codeauthor:: hompy
 """
 
+import io
 import os
+import json
+import zlib
 import time
+import base64
 import operator
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, succeed
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+from twisted.logger import Logger
 from pyspades.vxl import VXLData
+from pyspades.mapgenerator import ProgressiveMapGenerator
 from pyspades.contained import BlockAction, SetColor
 from pyspades.constants import *
 from pyspades.common import coordinates, make_color
@@ -37,6 +86,11 @@ from piqueserver.map import Map, MapNotFound, check_rotation
 from piqueserver.commands import command, admin
 from piqueserver.config import config
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 S_INVALID_MAP_NAME = 'Invalid map name'
 S_ROLLBACK_IN_PROGRESS = 'Rollback in progress'
 S_ROLLBACK_COMMENCED = '{player} commenced a rollback...'
@@ -45,20 +99,404 @@ S_NO_ROLLBACK_IN_PROGRESS = 'No rollback in progress'
 S_ROLLBACK_CANCELLED = 'Rollback cancelled by {player}'
 S_ROLLBACK_ENDED = 'Rollback ended. {result}'
 S_MAP_CHANGED = 'Map was changed'
-S_ROLLBACK_PROGRESS = 'Rollback progress {percent:.0%}'
-S_ROLLBACK_COLOR_PASS = 'Rollback doing color pass...'
+S_ROLLBACK_PROGRESS = 'Rollback progress {percent:.0%} ({rate:.0f} rows/s at {scale:.2f}x pace, ETA {eta:.0f}s)'
+S_ROLLBACK_COLOR_PASS = 'Rollback doing color pass... ({rate:.0f} packets/s at {scale:.2f}x pace)'
 S_ROLLBACK_TIME_TAKEN = 'Time taken: {seconds:.3}s'
+S_NO_SELECTION = 'Select an area using /sel first'
+S_NO_SNAPSHOT = 'No snapshot named {name}'
+S_SNAPSHOT_TAKEN = 'Snapshot {name} taken'
+S_SNAPSHOT_DROPPED = 'Snapshot {name} deleted'
+S_SNAPSHOT_RESERVED = 'Snapshot {name} can not be replaced or deleted'
+S_SNAPSHOT_ENTRY = '{name} ({age:.0f} min ago, {size:.1f} MB)'
+S_SNAPSHOTS = 'Snapshots ({size:.1f} MB): {entries}'
+S_ROLLBACK_ESTIMATING = 'Estimating rollback...'
+S_ROLLBACK_SCANNING = 'Comparing maps before the rollback...'
+S_ROLLBACK_ESTIMATE = ('Rollback would destroy {destroy}, build {build} and color {color} blocks: '
+                       '{packets} packets ({size:.0f} KB) per player, {eta:.0f}s at the current pace')
+S_MAP_RELOAD = 'Rollback is reloading the map. You will be put back where you were when you respawn'
+S_NO_CHECKPOINT = 'No rollback to resume'
+S_CHECKPOINT_OTHER_MAP = 'The rollback to resume is for {map}'
+S_CHECKPOINT_SAVED = 'Progress saved, /rollbackresume continues it'
+S_ROLLBACK_FAILED = 'Rollback failed, see the server log'
 
 NON_SURFACE_COLOR = (69, 43, 30)
 
 rollback_config = config.section('rollback')
 ROLLBACK_ON_GAME_END_OPTION = rollback_config.option(
     'rollback_on_game_end', False)
+DIFF_WORKERS_OPTION = rollback_config.option('diff_workers', 0)
+MAP_CACHE_SIZE_OPTION = rollback_config.option('map_cache_size', 300)
+SNAPSHOT_INTERVAL_OPTION = rollback_config.option('snapshot_interval', 60)
+SNAPSHOT_MEMORY_OPTION = rollback_config.option('snapshot_memory', 200)
+CHECKPOINT_INTERVAL_OPTION = rollback_config.option('checkpoint_interval', 30)
+RESUME_ON_LOAD_OPTION = rollback_config.option('resume_on_load', False)
+RELOAD_RATIO_OPTION = rollback_config.option('reload_ratio', 0)
 config_dir = config.config_dir
+checkpoint_path = os.path.join(config_dir, 'rollback_checkpoint.json')
+checkpoint_target_path = os.path.join(config_dir, 'rollback_target.vxl')
 
+# diff ops
+OP_DESTROY = 1
+OP_BUILD = 2
 
-@command(admin_only=True)
-def rollmap(connection, mapname=None, value_a=None, value_b=None):
+# packet sizes in bytes
+BLOCK_ACTION_SIZE = 15
+SET_COLOR_SIZE = 5
+PACKET_OVERHEAD = 12 # enet reliable command header
+
+ORIGINAL_SNAPSHOT = 'map'
+
+
+def vxl_column_offsets(data):
+    """
+    Byte offsets of all columns in serialized VXL data, indexed by y * 512 + x
+    """
+    offsets = []
+    i = 0
+    for column in range(512 * 512):
+        offsets.append(i)
+        while data[i]:
+            i += data[i] * 4
+        i += (data[i + 2] - data[i + 1] + 2) * 4
+    return offsets
+
+
+def with_column_offsets(data):
+    return data, array('I', vxl_column_offsets(data))
+
+
+def serialize_vxl(map):
+    """
+    Serialized data and column offsets of a map or snapshot that is not changed while this runs
+    """
+    return with_column_offsets(map.generate())
+
+
+def write_vxl(map, path):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(map.generate())
+    os.replace(path + '.tmp', path)
+
+
+def slice_columns(data, offsets, rows):
+    """
+    Copy the columns of rows [[column index]] out of serialized VXL data,
+    returning the copy and the column byte offsets in it for every row
+    """
+    chunks = []
+    starts = []
+    pos = 0
+    for row in rows:
+        row_starts = []
+        for column in row:
+            start = offsets[column]
+            end = offsets[column + 1] if column + 1 < len(offsets) else len(data)
+            row_starts.append(pos)
+            chunks.append(data[start:end])
+            pos += end - start
+        starts.append(row_starts)
+    return b''.join(chunks), starts
+
+
+def decode_columns(data, starts):
+    """
+    Solid mask, surface mask and packed colors (r << 16 | g << 8 | b) of the columns at byte offsets starts,
+    as (len(starts), 64) arrays
+    """
+    solid = np.zeros((len(starts), 64), bool)
+    surface = np.zeros((len(starts), 64), bool)
+    colors = np.zeros((len(starts), 64), np.uint32)
+    for k, i in enumerate(starts):
+        while True:
+            n, s, e = data[i], data[i + 1], data[i + 2]
+            top = e - s + 1
+            if top > 0:
+                colors[k, s:e + 1] = np.frombuffer(data, '<u4', top, i + 4) & 0xFFFFFF
+                surface[k, s:e + 1] = True
+            if n == 0:
+                solid[k, s:] = True
+                break
+            bottom = n - 1 - top
+            i += n * 4
+            air = data[i + 3]
+            solid[k, s:air] = True
+            if bottom > 0:
+                colors[k, air - bottom:air] = np.frombuffer(data, '<u4', bottom, i - bottom * 4) & 0xFFFFFF
+                surface[k, air - bottom:air] = True
+    return solid, surface, colors
+
+
+def diff_columns(cur_data, cur_starts, new_data, new_starts, z_range=(0, 64)):
+    """
+    Compare columns of two maps between z_range, returning ([(k, z, op)], [(k, z, packed color)])
+    where k indexes the columns. Blocks that only need a new color are destroyed and listed in both
+    """
+    cur_solid, old_surface, old_colors = decode_columns(cur_data, cur_starts)
+    new_solid, new_surface, new_colors = decode_columns(new_data, new_starts)
+    recolor = cur_solid & new_surface & (~old_surface | (old_colors != new_colors))
+    ops = np.zeros(cur_solid.shape, np.uint8)
+    ops[recolor | (cur_solid & ~new_solid)] = OP_DESTROY
+    ops[~cur_solid & new_solid & ~new_surface] = OP_BUILD
+    surface = recolor | (~cur_solid & new_solid & new_surface)
+    start_z, end_z = z_range
+    ops[:, :start_z] = ops[:, end_z:] = 0
+    surface[:, :start_z] = surface[:, end_z:] = False
+    return ([(int(k), int(z), int(ops[k, z])) for k, z in zip(*np.nonzero(ops))],
+            [(int(k), int(z), int(c)) for k, z, c in zip(*np.nonzero(surface), new_colors[surface])])
+
+
+def diff_sector(cur_data, new_data, rows, z_range):
+    """
+    Process pool entry point: diff_columns for every (x, cur_starts, new_starts) row of a sector
+    """
+    return [(x,) + diff_columns(cur_data, cur_starts, new_data, new_starts, z_range)
+            for x, cur_starts, new_starts in rows]
+
+
+def masked_ys(mask, x, start_y, end_y):
+    """
+    y values in [start_y, end_y) of columns set in a x * 512 + y mask
+    """
+    i = x * 512
+    return [y for y in range(start_y, end_y) if mask[i + y]]
+
+
+class RollbackJob:
+    """
+    Target and progress of a rollback, saved as a checkpoint so it can be resumed
+    """
+
+    def __init__(self, map_name, target, ranges, ignore_indestructable, only_dirty, mask=None, z_range=(0, 64)):
+        self.map_name = map_name
+        self.target = target # ['snapshot', name] or ['map', name]
+        self.ranges = ranges # start_x_a, start_y_a, end_x_a, end_y_a, start_x_b, start_y_b, end_x_b, end_y_b
+        self.ignore_indestructable = ignore_indestructable
+        self.only_dirty = only_dirty
+        self.z_range = list(z_range)
+        if mask is None:
+            start_x, start_y, end_x, end_y = ranges[:4]
+            mask = bytearray(512 * 512)
+            for x in range(start_x, end_x):
+                mask[x * 512 + start_y:x * 512 + end_y] = b'\x01' * (end_y - start_y)
+        self.mask = mask # x * 512 + y: 1 for columns not rolled back yet
+        self.surface = {} # (x, y, z): color, sorted into a list for the color pass
+        self.colored = None # blocks colored by the color pass, None before it
+        self.uncolored = bytearray(512 * 512) # x * 512 + y: 1 for columns with surface blocks still to color
+        self.map_load = None # map load the rollback was applied to
+
+    def restart(self):
+        """
+        Roll back the whole range again, after the map was reloaded without the rollback's changes
+        """
+        start_x, start_y, end_x, end_y = self.ranges[:4]
+        self.mask = bytearray(512 * 512)
+        for x in range(start_x, end_x):
+            self.mask[x * 512 + start_y:x * 512 + end_y] = b'\x01' * (end_y - start_y)
+        self.only_dirty = False # dirty columns of the earlier load are lost
+        self.surface = {}
+        self.colored = None
+        self.uncolored = bytearray(512 * 512)
+
+    def dump(self):
+        # Surface blocks are not saved. Their columns stay in the saved mask until the job finishes, and diffing
+        # them again on resume only yields the colors that are still missing
+        mask = int.from_bytes(self.mask, 'big') | int.from_bytes(self.uncolored, 'big')
+        return json.dumps({
+            'map': self.map_name,
+            'target': self.target,
+            'ranges': self.ranges,
+            'ignore_indestructable': self.ignore_indestructable,
+            'only_dirty': self.only_dirty,
+            'z_range': self.z_range,
+            'mask': base64.b64encode(zlib.compress(mask.to_bytes(512 * 512, 'big'))).decode(),
+            'map_load': self.map_load,
+        })
+
+    @classmethod
+    def load(cls, text):
+        state = json.loads(text)
+        job = cls(state['map'], state['target'], state['ranges'], state['ignore_indestructable'],
+                  state['only_dirty'], bytearray(zlib.decompress(base64.b64decode(state['mask']))),
+                  state['z_range'])
+        job.map_load = state.get('map_load')
+        for x, y, z, *color in state.get('surface', ()): # checkpoints of older versions
+            job.mask[x * 512 + y] = 1
+        return job
+
+
+def rollback_cost(counts):
+    """
+    Packets and bytes per player of a rollback with the given diff counts
+    """
+    set_colors = len(counts['colors']) + 1
+    block_actions = counts[OP_DESTROY] + counts[OP_BUILD] + counts['recolor'] + counts['surface']
+    size = block_actions * (BLOCK_ACTION_SIZE + PACKET_OVERHEAD) + set_colors * (SET_COLOR_SIZE + PACKET_OVERHEAD)
+    return block_actions + set_colors, size
+
+
+def column_point(data, i, z):
+    """
+    Solidity and color of voxel z in the serialized VXL column at byte offset i. Color is None if not stored
+    """
+    while True:
+        n, s, e = data[i], data[i + 1], data[i + 2]
+        if z < s:
+            return False, None
+        if z <= e:
+            i += 4 + (z - s) * 4
+            return True, (data[i + 2], data[i + 1], data[i])
+        if n == 0:
+            return True, None
+        bottom = n - 1 - (e - s + 1)
+        i += n * 4
+        air = data[i + 3]
+        if z < air - bottom:
+            return True, None
+        if z < air:
+            i -= (air - z) * 4
+            return True, (data[i + 2], data[i + 1], data[i])
+
+
+class Snapshot:
+    """
+    Serialized columns of every sector (indexed x // 64 * 8 + y // 64, columns ordered x-major) with their byte offsets.
+    Sectors that did not change since the previous snapshot share its data
+    """
+
+    def __init__(self, name, sectors):
+        self.name = name
+        self.time = time.time()
+        self.sectors = sectors # [(data, column offsets)]
+
+    def column(self, x, y):
+        data, starts = self.sectors[x // 64 * 8 + y // 64]
+        return data, starts[(x % 64) * 64 + y % 64]
+
+    def get_solid(self, x, y, z):
+        return column_point(*self.column(x, y), z)[0]
+
+    def get_color(self, x, y, z):
+        return column_point(*self.column(x, y), z)[1] or NON_SURFACE_COLOR
+
+    def generate(self):
+        """
+        Serialized VXL data of the whole map
+        """
+        chunks = []
+        for y in range(512):
+            for x in range(512):
+                data, starts = self.sectors[x // 64 * 8 + y // 64]
+                k = (x % 64) * 64 + y % 64
+                chunks.append(data[starts[k]:starts[k + 1] if k < 4095 else len(data)])
+        return b''.join(chunks)
+
+
+def snapshot_sizes(snapshots):
+    """
+    Total bytes used by snapshots and bytes used by each that are not shared with another
+    """
+    owners = {}
+    for snapshot in snapshots:
+        for data, starts in snapshot.sectors:
+            owners.setdefault(id(data), [len(data) + starts.itemsize * len(starts), set()])[1].add(snapshot.name)
+    own = {snapshot.name: 0 for snapshot in snapshots}
+    for size, names in owners.values():
+        if len(names) == 1:
+            own[next(iter(names))] += size
+    return sum(size for size, names in owners.values()), own
+
+
+class MapCache:
+    """
+    LRU of parsed maps with their serialized data and column offsets, keyed by path and checked against the file's mtime
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.maps = OrderedDict() # path: (mtime, map, data, offsets, size)
+
+    def get(self, path, mtime):
+        entry = self.maps.get(path)
+        if entry is None:
+            return None
+        if entry[0] != mtime:
+            self.remove(path)
+            return None
+        self.maps.move_to_end(path)
+        return entry[1]
+
+    def put(self, path, mtime, map):
+        self.remove(path)
+        data = map.generate()
+        offsets = array('I', vxl_column_offsets(data))
+        # rough in-memory size of VXLData (2 MB of geometry bits, several times the serialized colors) and our copies
+        size = 2 * 1024 * 1024 + 8 * len(data) + len(data) + offsets.itemsize * len(offsets)
+        self.maps[path] = (mtime, map, data, offsets, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self.maps) > 1:
+            self.remove(next(iter(self.maps)))
+
+    def remove(self, path):
+        entry = self.maps.pop(path, None)
+        if entry is not None:
+            self.size -= entry[4]
+
+    def serialized(self, map):
+        """
+        Serialized data and column offsets of a cached map, or None
+        """
+        for mtime, cached, data, offsets, size in self.maps.values():
+            if cached is map:
+                return data, offsets
+        return None
+
+
+log = Logger()
+
+map_cache = MapCache(MAP_CACHE_SIZE_OPTION.get() * 1024 * 1024)
+
+diff_pool = None
+
+# Run in each diff worker before any task. piqueserver loads scripts under names that can't be imported, so the worker
+# loads this file under the same name for diff_sector to be unpickled
+DIFF_WORKER_INIT = """
+import sys
+import importlib.util
+spec = importlib.util.spec_from_file_location(name, path)
+module = importlib.util.module_from_spec(spec)
+sys.modules[name] = module
+spec.loader.exec_module(module)
+"""
+
+
+def get_diff_pool():
+    """
+    Process pool for sector diffs, or None if the diff runs in the server process
+    """
+    global diff_pool
+    workers = DIFF_WORKERS_OPTION.get() or os.cpu_count() or 1
+    if np is None or workers < 2:
+        return None
+    if diff_pool is None:
+        # spawned, since forking the server would copy locks held by its other threads
+        diff_pool = ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'), initializer=exec,
+                                        initargs=(DIFF_WORKER_INIT, {'name': __name__, 'path': __file__}))
+        reactor.addSystemEventTrigger('before', 'shutdown', diff_pool.shutdown, wait=False)
+    return diff_pool
+
+
+def reset_diff_pool():
+    """
+    Shut down the diff pool after a failed diff, so the next one starts new workers in case these died
+    """
+    global diff_pool
+    if diff_pool is not None:
+        diff_pool.shutdown(wait=False)
+        diff_pool = None
+
+
+def rollmap_ranges(value_a, value_b):
     start_x_a, start_y_a, end_x_a, end_y_a = 0, 0, 512, 512
     start_x_b, start_y_b, end_x_b, end_y_b = 0, 0, 512, 512
     if value_a is not None:
@@ -69,14 +507,81 @@ def rollmap(connection, mapname=None, value_a=None, value_b=None):
     if value_b is not None:
         start_x_b, start_y_b = coordinates(value_b)
         end_x_b, end_y_b = start_x_b + 64, start_y_b + 64
+    return (start_x_a, start_y_a, end_x_a, end_y_a,
+            start_x_b, start_y_b, end_x_b, end_y_b)
+
+
+@command(admin_only=True)
+def rollmap(connection, mapname=None, value_a=None, value_b=None):
+    return connection.protocol.start_rollback(connection, mapname, *rollmap_ranges(value_a, value_b))
+
+
+@command(admin_only=True)
+def rollmapdry(connection, mapname=None, value_a=None, value_b=None):
+    return connection.protocol.start_rollback(connection, mapname, *rollmap_ranges(value_a, value_b),
+                                              dry_run=True)
+
+
+def rollback_snapshot(connection, value, snapshot, dry_run=False):
+    protocol = connection.protocol
+    if snapshot is None and value in protocol.snapshots:
+        value, snapshot = None, value
+    if snapshot is not None and snapshot not in protocol.snapshots:
+        return S_NO_SNAPSHOT.format(name=snapshot)
+    start_x, start_y, end_x, end_y = 0, 0, 512, 512
+    if value is not None:
+        start_x, start_y = coordinates(value)
+        end_x, end_y = start_x + 64, start_y + 64
+    return protocol.start_rollback(connection, None,
+                                   start_x, start_y, end_x, end_y,
+                                   start_x, start_y, end_x, end_y,
+                                   snapshot=snapshot, dry_run=dry_run)
+
+
+@command(admin_only=True)
+def rollback(connection, value=None, snapshot=None):
+    return rollback_snapshot(connection, value, snapshot)
+
+
+@command(admin_only=True)
+def rollbackdry(connection, value=None, snapshot=None):
+    return rollback_snapshot(connection, value, snapshot, dry_run=True)
+
+
+def selection_box(connection):
+    """
+    x and y ranges and z range of the area selected with creativetools.py, or None
+    """
+    if not (getattr(connection, 'sel_a', None) and getattr(connection, 'sel_b', None)):
+        return None
+    low = [min(x) for x in zip(connection.sel_a, connection.sel_b)]
+    high = [max(x) + 1 for x in zip(connection.sel_a, connection.sel_b)]
+    return low[0], low[1], high[0], high[1], (low[2], high[2])
+
+
+@command(admin_only=True)
+def rollmapsel(connection, mapname):
+    box = selection_box(connection)
+    if box is None:
+        return S_NO_SELECTION
+    start_x, start_y, end_x, end_y, z_range = box
     return connection.protocol.start_rollback(connection, mapname,
-                                start_x_a, start_y_a, end_x_a, end_y_a,
-                                start_x_b, start_y_b, end_x_b, end_y_b)
+                                              start_x, start_y, end_x, end_y,
+                                              start_x, start_y, end_x, end_y, z_range=z_range)
 
 
 @command(admin_only=True)
-def rollback(connection, value=None):
-    return rollmap(connection, value_a=value)
+def rollbacksel(connection, snapshot=None):
+    box = selection_box(connection)
+    if box is None:
+        return S_NO_SELECTION
+    if snapshot is not None and snapshot not in connection.protocol.snapshots:
+        return S_NO_SNAPSHOT.format(name=snapshot)
+    start_x, start_y, end_x, end_y, z_range = box
+    return connection.protocol.start_rollback(connection, None,
+                                              start_x, start_y, end_x, end_y,
+                                              start_x, start_y, end_x, end_y,
+                                              snapshot=snapshot, z_range=z_range)
 
 
 @command(admin_only=True)
@@ -84,16 +589,77 @@ def rollbackcancel(connection):
     return connection.protocol.cancel_rollback(connection)
 
 
+@command(admin_only=True)
+def rollbackresume(connection):
+    return connection.protocol.resume_rollback(connection)
+
+
+@command(admin_only=True)
+def snapshot(connection, name):
+    if name == ORIGINAL_SNAPSHOT:
+        return S_SNAPSHOT_RESERVED.format(name=name)
+    connection.protocol.take_snapshot(name)
+    return S_SNAPSHOT_TAKEN.format(name=name)
+
+
+@command(admin_only=True)
+def snapshots(connection):
+    snapshots = connection.protocol.snapshots.values()
+    total, own = snapshot_sizes(snapshots)
+    entries = ', '.join(S_SNAPSHOT_ENTRY.format(name=x.name, age=(time.time() - x.time) / 60,
+                                                size=own[x.name] / 1024 / 1024) for x in snapshots)
+    return S_SNAPSHOTS.format(size=total / 1024 / 1024, entries=entries)
+
+
+@command(admin_only=True)
+def dropsnapshot(connection, name):
+    if name == ORIGINAL_SNAPSHOT:
+        return S_SNAPSHOT_RESERVED.format(name=name)
+    if connection.protocol.snapshots.pop(name, None) is None:
+        return S_NO_SNAPSHOT.format(name=name)
+    return S_SNAPSHOT_DROPPED.format(name=name)
+
+
 def apply_script(protocol, connection, config):
     rollback_on_game_end = ROLLBACK_ON_GAME_END_OPTION.get()
+    snapshot_interval = SNAPSHOT_INTERVAL_OPTION.get()
+    snapshot_memory = SNAPSHOT_MEMORY_OPTION.get() * 1024 * 1024
+    checkpoint_interval = CHECKPOINT_INTERVAL_OPTION.get()
+    resume_on_load = RESUME_ON_LOAD_OPTION.get()
+    reload_ratio = RELOAD_RATIO_OPTION.get()
 
     class RollbackConnection(connection):
+        rollback_removed_seen = 0
 
         def on_block_destroy(self, x, y, z, value):
             if self.protocol.rollback_in_progress:
                 return False
             return connection.on_block_destroy(self, x, y, z, value)
 
+        def on_block_build(self, x, y, z):
+            self.protocol.mark_dirty(x, y)
+            return connection.on_block_build(self, x, y, z)
+
+        def on_line_build(self, points):
+            for x, y, z in points:
+                self.protocol.mark_dirty(x, y)
+            return connection.on_line_build(self, points)
+
+        def on_block_removed(self, x, y, z):
+            self.protocol.mark_dirty(x, y)
+            # total_blocks_removed already includes every block destroy_point took down with this one
+            removed = self.total_blocks_removed - self.rollback_removed_seen
+            self.rollback_removed_seen = self.total_blocks_removed
+            if removed > 1:
+                self.protocol.mark_collapse()
+            return connection.on_block_removed(self, x, y, z)
+
+        def on_spawn(self, pos):
+            saved = self.protocol.reload_positions.pop(self.player_id, None)
+            if saved is not None and saved[0] == self.team.id:
+                self.set_location(saved[1])
+            return connection.on_spawn(self, pos)
+
     class RollbackProtocol(protocol):
         rollback_in_progress = False
         rollback_max_rows = 10  # per 'cycle', intended to cap cpu usage
@@ -103,43 +669,421 @@ def apply_script(protocol, connection, config):
         rollback_max_unique_packets = 12
         rollback_time_between_cycles = 0.01
         rollback_time_between_progress_updates = 10.0
+        # the limits above are scaled between these depending on server load
+        rollback_min_scale = 0.25
+        rollback_max_scale = 8.0
+        rollback_target_lag = 0.02  # seconds a cycle may start late before backing off
+        rollback_latency_margin = 100  # ms of latency over a player's best before backing off
+        rollback_scale = 1.0
+        rollback_last_cycle = None
+        rollback_best_latency = None
+        rollback_packets = 0
         rollback_start_time = None
         rollback_last_chat = None
         rollback_rows = None
         rollback_total_rows = None
+        rollback_job = None
+        rollback_scan_call = None
+        rollback_last_checkpoint = None
+        map_load = None # changes with every map load
+        snapshots = {} # name: Snapshot, oldest first
+        snapshot_call = None
+        changed_sectors = None # 1 if the sector changed since the last snapshot
+        dirty_columns = None # x * 512 + y: 1 if the column changed since the map was loaded
+        dirty_complete = True # False once blocks collapsed somewhere dirty_columns doesn't know about
+        map_version = 0 # changes with every change to the current map
+        serialized_map = None # (map, map_version, (data, column offsets)) of the current map, see serialize_map
+        rollback_target = None # snapshot last written to checkpoint_target_path
+
+        def __init__(self, *arg, **kw):
+            protocol.__init__(self, *arg, **kw)
+            self.reload_positions = {} # player id: (team id, position) from before resend_map
+            self.rollback_target_write = succeed(None) # writes of checkpoint_target_path, one at a time
+            reactor.addSystemEventTrigger('before', 'shutdown', self.save_rollback_checkpoint)
 
         # rollback
 
         def start_rollback(self, connection, mapname,
                             start_x_a, start_y_a, end_x_a, end_y_a,
                             start_x_b, start_y_b, end_x_b, end_y_b,
-                            ignore_indestructable=True):
-            if self.rollback_in_progress:
+                            ignore_indestructable=True, snapshot=None, dry_run=False, z_range=(0, 64)):
+            if self.rollback_in_progress or self.rollback_scan_call is not None:
                 return S_ROLLBACK_IN_PROGRESS
             if mapname is None:
-                map = self.rollback_map
+                snapshot = snapshot or ORIGINAL_SNAPSHOT
+                map = self.snapshots[snapshot]
+                target = ['snapshot', snapshot]
             else:
                 try:
                     maps = check_rotation([mapname])
                     if not maps:
                         return S_INVALID_MAP_NAME
-                    map = Map(maps[0], os.path.join(config_dir, "maps")).data
+                    map = self.load_rollback_map(maps[0])
+                except MapNotFound as error:
+                    return 'Map not found'
+                target = ['map', mapname]
+            only_dirty = target == ['snapshot', ORIGINAL_SNAPSHOT] and self.dirty_complete
+            job = RollbackJob(self.map_info.name, target,
+                              [start_x_a, start_y_a, end_x_a, end_y_a, start_x_b, start_y_b, end_x_b, end_y_b],
+                              ignore_indestructable, only_dirty, z_range=z_range)
+            job.map_load = self.map_load
+            if only_dirty:
+                if dry_run or tuple(z_range) != (0, 64): # columns rolled back only partly stay dirty
+                    for x in range(start_x_a, end_x_a):
+                        i = x * 512
+                        job.mask[i + start_y_a:i + end_y_a] = self.dirty_columns[i + start_y_a:i + end_y_a]
+                else:
+                    self.take_dirty(job.mask, start_x_a, start_y_a, end_x_a, end_y_a)
+            if dry_run:
+                self.scan_rollback(map, job, lambda counts, rows: connection.send_chat(
+                    self.format_rollback_estimate(counts)), False)
+                return S_ROLLBACK_ESTIMATING
+            if not reload_ratio:
+                return self.run_job(connection, job, map)
+            self.scan_rollback(map, job, lambda counts, rows: self.choose_rollback(
+                connection, job, map, counts, rows), True)
+            return S_ROLLBACK_SCANNING
+
+        def run_job(self, connection, job, map, rows=None):
+            if self.rollback_in_progress: # before replacing the running job's checkpoint
+                return S_ROLLBACK_IN_PROGRESS
+            if isinstance(map, Snapshot): # snapshots are kept in memory only
+                self.write_rollback_target(map)
+            generator = self.create_rollback_generator(self.map, map, job, rows)
+            start_x_a, start_y_a, end_x_a, end_y_a = job.ranges[:4]
+            total_rows = end_x_a - start_x_a
+            if rows is not None:
+                total_rows = len(rows)
+            elif get_diff_pool() is not None: # rows are counted per sector
+                total_rows *= (end_y_a - start_y_a + 63) // 64
+            if job.colored is not None:
+                total_rows = 0
+            self.rollback_job = job
+            self.save_rollback_checkpoint()
+            return self.run_rollback(connection, generator, total_rows)
+
+        def scan_rollback(self, map, job, callback, keep_rows):
+            """
+            Diff the job without applying it, a few milliseconds per tick, then call callback(counts, rows).
+            rows is the diff output if keep_rows, otherwise None
+            """
+            diff = self.rollback_diff()(self.map, map, *job.ranges, job.ignore_indestructable, job.mask,
+                                                     job.z_range)
+            counts = {'rows': 0, OP_DESTROY: 0, OP_BUILD: 0, 'recolor': 0, 'surface': 0, 'colors': set()}
+            rows = [] if keep_rows else None
+
+            def step():
+                deadline = time.monotonic() + self.rollback_time_between_cycles
+                try:
+                    for row in diff:
+                        if row is None:
+                            return
+                        ax, ys, ops, surface = row
+                        counts['rows'] += 1
+                        for ay, z, op in ops:
+                            if op == OP_DESTROY and (ax, ay, z) in surface: # destroyed, then built with the new color
+                                counts['recolor'] += 1
+                            else:
+                                counts[op] += 1
+                        counts['surface'] += len(surface)
+                        counts['colors'].update(surface.values())
+                        if keep_rows:
+                            rows.append(row)
+                        if time.monotonic() > deadline:
+                            return
+                except Exception: # e.g. a broken diff pool
+                    log.failure('Rollback scan failed')
+                    reset_diff_pool()
+                    self.rollback_scan_call.stop()
+                    self.rollback_scan_call = None
+                    self.return_dirty(job)
+                    self.broadcast_chat(S_ROLLBACK_FAILED, irc=True)
+                    return
+                self.rollback_scan_call.stop()
+                self.rollback_scan_call = None
+                callback(counts, rows)
+
+            self.rollback_scan_call = LoopingCall(step)
+            self.rollback_scan_call.start(self.rollback_time_between_cycles, now=False)
+
+        def format_rollback_estimate(self, counts):
+            packets, size = rollback_cost(counts)
+            return S_ROLLBACK_ESTIMATE.format(
+                destroy=counts[OP_DESTROY], build=counts[OP_BUILD] + counts['surface'] - counts['recolor'],
+                color=counts['recolor'], packets=packets, size=size / 1024,
+                eta=self.estimate_rollback_time(packets, counts['rows']))
+
+        def estimate_rollback_time(self, packets, rows):
+            """
+            Seconds rollback_cycle takes for packets unique packets and rows diff rows at the current pace
+            """
+            cycles = max(packets / self.rollback_max_unique_packets,
+                         packets * len(self.connections) / self.rollback_max_packets,
+                         rows / self.rollback_max_rows)
+            return cycles / self.rollback_scale * self.rollback_time_between_cycles
+
+        def choose_rollback(self, connection, job, map, counts, rows):
+            """
+            Send the scanned rows block by block, or apply them at once and resend the map
+            when that is less than reload_ratio times cheaper
+            """
+            if self.rollback_in_progress: # e.g. /undoedits started while scanning
+                self.return_dirty(job)
+                if connection is not None and connection in self.players.values():
+                    connection.send_chat(S_ROLLBACK_IN_PROGRESS)
+                return
+            packets, size = rollback_cost(counts)
+            serialized = self.current_serialized_map() # left by the scan, unless the map changed since
+            map_size = len(zlib.compress(serialized[0] if serialized else self.map.generate(), 1))
+            if self.connections and size < map_size * reload_ratio:
+                message = self.run_job(connection, job, map, rows)
+                if message and connection is not None and connection in self.players.values():
+                    connection.send_chat(message)
+                return
+            name = (connection.name if connection is not None
+                    else S_AUTOMATIC_ROLLBACK_PLAYER_NAME)
+            self.broadcast_chat(S_ROLLBACK_COMMENCED.format(player=name), irc=True)
+            start = time.monotonic()
+            for ax, ys, ops, surface in rows:
+                for ay, z, op in ops:
+                    if op == OP_DESTROY:
+                        self.map.remove_point(ax, ay, z)
+                    else:
+                        self.map.set_point(ax, ay, z, NON_SURFACE_COLOR)
+                    self.mark_rolled_back(job, ax, ay)
+                for (x, y, z), color in surface.items():
+                    self.map.set_point(x, y, z, color)
+                    self.mark_rolled_back(job, x, y)
+            self.resend_map()
+            message = S_ROLLBACK_ENDED.format(result=S_ROLLBACK_TIME_TAKEN.format(seconds=time.monotonic() - start))
+            self.broadcast_chat(message, irc=True)
+
+        def resend_map(self):
+            """
+            Make every client download the map again. Players are put back where they were when they respawn
+            """
+            if not self.connections:
+                return
+            self.broadcast_chat(S_MAP_RELOAD)
+            data = ProgressiveMapGenerator(self.map, parent=True)
+            for player in list(self.connections.values()):
+                if player.player_id is None:
+                    continue
+                if player.map_data is not None:
+                    player.disconnect()
+                    continue
+                if player.team is not None and player.world_object is not None and player.hp:
+                    self.reload_positions[player.player_id] = (player.team.id, player.world_object.position.get())
+                player.reset()
+                player._send_connection_data()
+                player.send_map(data.get_child())
+                # The client starts over with the protocol fog color
+                if hasattr(player, 'sent_fog_color'): # fogtween.py
+                    player.sent_fog_color = None
+                if hasattr(player, 'current_sector'): # claims.py, sends the sector fog again
+                    player.current_sector = None
+                    player.view_changed = True
+            self.update_entities()
+
+        def resume_rollback(self, connection):
+            if self.rollback_in_progress:
+                return S_ROLLBACK_IN_PROGRESS
+            try:
+                with open(checkpoint_path) as f:
+                    job = RollbackJob.load(f.read())
+            except (OSError, ValueError, KeyError):
+                return S_NO_CHECKPOINT
+            if job.map_name != self.map_info.name:
+                return S_CHECKPOINT_OTHER_MAP.format(map=job.map_name)
+            if job.map_load != self.map_load: # the map was reloaded, so the rolled back columns were lost
+                job.restart()
+                job.map_load = self.map_load
+            kind, name = job.target
+            if kind == 'snapshot':
+                try:
+                    with open(checkpoint_target_path, 'rb') as f:
+                        map = VXLData(f)
+                except OSError:
+                    return S_NO_CHECKPOINT
+            else:
+                try:
+                    maps = check_rotation([name])
+                    if not maps:
+                        return S_INVALID_MAP_NAME
+                    map = self.load_rollback_map(maps[0])
                 except MapNotFound as error:
                     return 'Map not found'
+            return self.run_job(connection, job, map)
+
+        def write_rollback_target(self, snapshot):
+            """
+            Write the snapshot a rollback goes to into checkpoint_target_path in a thread, unless it is there already
+            """
+            if snapshot is self.rollback_target:
+                return
+            self.rollback_target = snapshot
+            self.rollback_target_write.addBoth(lambda result: deferToThread(write_vxl, snapshot, checkpoint_target_path))
+            self.rollback_target_write.addErrback(lambda failure: log.failure('Saving the rollback target failed', failure))
+
+        def save_rollback_checkpoint(self):
+            if self.rollback_job is None:
+                return
+            with open(checkpoint_path + '.tmp', 'w') as f:
+                f.write(self.rollback_job.dump())
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+            self.rollback_last_checkpoint = time.monotonic()
+
+        def load_rollback_map(self, rot_info):
+            """
+            Parsed map data of a rotation entry, from map_cache when its file has not changed
+            """
+            load_dir = os.path.join(config_dir, "maps")
+            path = rot_info.get_map_filename(load_dir)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError: # generated map
+                return Map(rot_info, load_dir).data
+            map = map_cache.get(path, mtime)
+            if map is None:
+                map = Map(rot_info, load_dir).data
+                map_cache.put(path, mtime, map)
+            return map
+
+        def current_serialized_map(self):
+            """
+            Serialized data and column offsets of the current map if they are still up to date, otherwise None
+            """
+            if self.serialized_map is None:
+                return None
+            map, version, serialized = self.serialized_map
+            if map is not self.map or version != self.map_version:
+                return None
+            return serialized
+
+        def serialize_map(self, map):
+            """
+            Deferred serialized data and column offsets of a map or snapshot. Cached maps are not serialized again,
+            neither is the current map until it changes, and column offsets are found in a thread
+            """
+            cached = map_cache.serialized(map)
+            if cached is None and map is self.map:
+                cached = self.current_serialized_map()
+            if cached is not None:
+                return succeed(cached)
+            if map is not self.map: # targets don't change while they are diffed
+                return deferToThread(serialize_vxl, map)
+            version = self.map_version
+
+            def serialized(result):
+                self.serialized_map = (map, version, result)
+                return result
+
+            # the current map changes on this thread, so it is copied here
+            return deferToThread(with_column_offsets, map.generate()).addCallback(serialized)
+
+        def serialized_maps(self, cur, new):
+            """
+            Yield None until cur and new are serialized, then return their serialized data and column offsets
+            """
+            done = []
+            maps = [cur] if new is cur else [cur, new]
+            gatherResults([self.serialize_map(x) for x in maps], consumeErrors=True).addBoth(done.append)
+            while not done:
+                yield None
+            if isinstance(done[0], Failure):
+                done[0].raiseException()
+            return done[0][0], done[0][-1]
+
+        def take_snapshot(self, name):
+            """
+            Snapshot the current map, copying only sectors changed since the last snapshot.
+            Old snapshots are dropped while all of them use more than snapshot_memory
+            """
+            previous = next(reversed(list(self.snapshots.values())), None)
+            data, offsets = self.current_serialized_map() or (None, None)
+            sectors = []
+            for i in range(64):
+                if previous is not None and not self.changed_sectors[i]:
+                    sectors.append(previous.sectors[i])
+                    continue
+                if data is None:
+                    data, offsets = with_column_offsets(self.map.generate())
+                    self.serialized_map = (self.map, self.map_version, (data, offsets))
+                sector_x, sector_y = i // 8 * 64, i % 8 * 64
+                sector, (starts,) = slice_columns(data, offsets,
+                    [[y * 512 + x for x in range(sector_x, sector_x + 64) for y in range(sector_y, sector_y + 64)]])
+                sectors.append((sector, array('I', starts)))
+            self.changed_sectors = bytearray(64)
+            self.snapshots.pop(name, None)
+            self.snapshots[name] = Snapshot(name, sectors)
+            for old_name in list(self.snapshots):
+                if snapshot_sizes(self.snapshots.values())[0] <= snapshot_memory:
+                    break
+                if old_name not in (ORIGINAL_SNAPSHOT, name):
+                    del self.snapshots[old_name]
+
+        def take_periodic_snapshot(self):
+            self.take_snapshot(time.strftime('%H:%M'))
+
+        def mark_dirty(self, x, y):
+            # neighbouring columns are marked as well, since their blocks may have become surface blocks
+            self.map_version += 1
+            if self.dirty_columns is None:
+                return
+            for nx in range(max(int(x) - 1, 0), min(int(x) + 2, 512)):
+                for ny in range(max(int(y) - 1, 0), min(int(y) + 2, 512)):
+                    self.dirty_columns[nx * 512 + ny] = 1
+                    self.changed_sectors[nx // 64 * 8 + ny // 64] = 1
+
+        def mark_collapse(self):
+            # Floating blocks fell at unknown columns
+            self.map_version += 1
+            if self.dirty_columns is None:
+                return
+            self.dirty_complete = False
+            self.changed_sectors[:] = b'\x01' * 64
+
+        def take_dirty(self, mask, start_x, start_y, end_x, end_y):
+            """
+            Move dirty columns of a range into mask, so edits made during the rollback mark them dirty again
+            """
+            for x in range(start_x, end_x):
+                i = x * 512
+                mask[i + start_y:i + end_y] = self.dirty_columns[i + start_y:i + end_y]
+                self.dirty_columns[i + start_y:i + end_y] = bytes(end_y - start_y)
+
+        def return_dirty(self, job):
+            """
+            Mark the columns an unfinished rollback to the original map has not rolled back (or colored) dirty again,
+            since take_dirty cleared them
+            """
+            if not job.only_dirty or self.dirty_columns is None:
+                return
+            dirty = (int.from_bytes(self.dirty_columns, 'big') | int.from_bytes(job.mask, 'big') |
+                     int.from_bytes(job.uncolored, 'big'))
+            self.dirty_columns[:] = dirty.to_bytes(512 * 512, 'big')
+
+        def run_rollback(self, connection, generator, total_rows):
+            """
+            Pace out a generator that broadcasts block packets, yielding the number of packets sent, 0 after each row,
+            or None while it waits for diff results
+            """
+            if self.rollback_in_progress:
+                return S_ROLLBACK_IN_PROGRESS
             name = (connection.name if connection is not None
                     else S_AUTOMATIC_ROLLBACK_PLAYER_NAME)
             message = S_ROLLBACK_COMMENCED.format(player=name)
             self.broadcast_chat(message, irc=True)
-            self.packet_generator = self.create_rollback_generator(
-                self.map, map,
-                start_x_a, start_y_a, end_x_a, end_y_a,
-                start_x_b, start_y_b, end_x_b, end_y_b,
-                ignore_indestructable)
+            self.packet_generator = generator
             self.rollback_in_progress = True
             self.rollback_start_time = time.monotonic()
             self.rollback_last_chat = self.rollback_start_time
             self.rollback_rows = 0
-            self.rollback_total_rows = end_x_a - start_x_a
+            self.rollback_total_rows = total_rows
+            self.rollback_scale = 1.0
+            self.rollback_last_cycle = self.rollback_start_time
+            self.rollback_best_latency = {}
+            self.rollback_packets = 0
             self.cycle_call = LoopingCall(self.rollback_cycle)
             self.cycle_call.start(self.rollback_time_between_cycles)
 
@@ -149,11 +1093,22 @@ def apply_script(protocol, connection, config):
             result = S_ROLLBACK_CANCELLED.format(player=connection.name)
             self.end_rollback(result)
 
-        def end_rollback(self, result):
+        def end_rollback(self, result, keep_checkpoint=False, finished=False):
             self.rollback_in_progress = False
             self.cycle_call.stop()
             self.cycle_call = None
             self.packet_generator = None
+            if self.rollback_job is not None:
+                if not finished:
+                    self.return_dirty(self.rollback_job)
+                if keep_checkpoint:
+                    self.save_rollback_checkpoint()
+                else: # the target is kept for the next rollback to the same snapshot
+                    try:
+                        os.remove(checkpoint_path)
+                    except OSError:
+                        pass
+                self.rollback_job = None
             self.update_entities()
             message = S_ROLLBACK_ENDED.format(result=result)
             self.broadcast_chat(message, irc=True)
@@ -161,71 +1116,188 @@ def apply_script(protocol, connection, config):
         def rollback_cycle(self):
             if not self.rollback_in_progress:
                 return
+            self.adjust_rollback_pace()
+            max_rows = self.rollback_max_rows * self.rollback_scale
+            max_unique_packets = self.rollback_max_unique_packets * self.rollback_scale
+            max_packets = self.rollback_max_packets * self.rollback_scale
             try:
                 sent_unique = sent_total = rows = 0
                 while True:
-                    if rows > self.rollback_max_rows:
+                    if rows > max_rows:
                         break
-                    if sent_unique > self.rollback_max_unique_packets:
+                    if sent_unique > max_unique_packets:
                         break
-                    if sent_total > self.rollback_max_packets:
+                    if sent_total > max_packets:
                         break
                     sent = next(self.packet_generator)
+                    if sent is None:
+                        break
                     sent_unique += sent
                     sent_total += sent * len(self.connections)
                     rows += (sent == 0)
+                    self.rollback_packets += sent
                 self.rollback_rows += rows
                 if (time.monotonic() - self.rollback_last_chat >
                         self.rollback_time_between_progress_updates):
                     self.rollback_last_chat = time.monotonic()
-                    progress = float(self.rollback_rows) / \
-                        self.rollback_total_rows
+                    progress = (float(self.rollback_rows) / self.rollback_total_rows
+                                if self.rollback_total_rows else 1.0)
+                    elapsed = time.monotonic() - self.rollback_start_time
                     if progress < 1.0:
-                        message = S_ROLLBACK_PROGRESS.format(percent=progress)
+                        rate = self.rollback_rows / elapsed
+                        eta = (self.rollback_total_rows - self.rollback_rows) / rate if rate else 0
+                        message = S_ROLLBACK_PROGRESS.format(percent=progress, rate=rate,
+                                                             scale=self.rollback_scale, eta=eta)
                         self.broadcast_chat(message)
                     else:
-                        self.broadcast_chat(S_ROLLBACK_COLOR_PASS)
+                        self.broadcast_chat(S_ROLLBACK_COLOR_PASS.format(
+                            rate=self.rollback_packets / elapsed, scale=self.rollback_scale))
+                if (self.rollback_job is not None and
+                        time.monotonic() - self.rollback_last_checkpoint > checkpoint_interval):
+                    self.save_rollback_checkpoint()
             except (StopIteration):
                 elapsed = time.monotonic() - self.rollback_start_time
                 message = S_ROLLBACK_TIME_TAKEN.format(seconds=elapsed)
-                self.end_rollback(message)
+                self.end_rollback(message, finished=True)
+            except Exception: # e.g. a broken diff pool
+                log.failure('Rollback failed')
+                reset_diff_pool()
+                if self.rollback_job is not None: # progress up to the last row is kept
+                    self.end_rollback('%s. %s' % (S_ROLLBACK_FAILED, S_CHECKPOINT_SAVED), keep_checkpoint=True)
+                else:
+                    self.end_rollback(S_ROLLBACK_FAILED)
 
-        def create_rollback_generator(self, cur, new,
-                            start_x_a, start_y_a, end_x_a, end_y_a,
-                            start_x_b, start_y_b, end_x_b, end_y_b,
-                            ignore_indestructable):
-            surface = {}
+        def adjust_rollback_pace(self):
+            """
+            Scale the per cycle limits: back off when cycles start late (reactor is busy)
+            or player latency rises above its best value, speed up otherwise
+            """
+            now = time.monotonic()
+            lag = now - self.rollback_last_cycle - self.rollback_time_between_cycles
+            self.rollback_last_cycle = now
+            congested = lag > self.rollback_target_lag
+            for player in self.players.values():
+                latency = getattr(player, 'latency', None)
+                if latency is None:
+                    continue
+                best = self.rollback_best_latency.get(player.player_id)
+                if best is None or latency < best:
+                    self.rollback_best_latency[player.player_id] = latency
+                elif latency - best > self.rollback_latency_margin:
+                    congested = True
+            if congested:
+                self.rollback_scale = max(self.rollback_scale * 0.7, self.rollback_min_scale)
+            else:
+                self.rollback_scale = min(self.rollback_scale * 1.05, self.rollback_max_scale)
+
+        def rollback_diff(self):
+            """
+            Fastest available diff_rows variant
+            """
+            if np is None:
+                return self.diff_rows
+            elif get_diff_pool() is None:
+                return self.diff_rows_numpy
+            return self.diff_rows_parallel
+
+        def mark_rolled_back(self, job, x, y):
+            if job.only_dirty:
+                self.changed_sectors[x // 64 * 8 + y // 64] = 1
+                self.map_version += 1
+            else: # the map now differs from the original here
+                self.mark_dirty(x, y)
+
+        def create_rollback_generator(self, cur, new, job, rows=None):
             block_action = BlockAction()
             block_action.player_id = 31
             set_color = SetColor()
             set_color.value = make_color(*NON_SURFACE_COLOR)
             set_color.player_id = 31
             self.broadcast_contained(set_color, save=True)
-            old = cur.copy()
+            if job.colored is None:
+                if rows is None:
+                    rows = self.rollback_diff()(cur, new, *job.ranges, job.ignore_indestructable, job.mask,
+                                                     job.z_range)
+                for row in rows:
+                    if row is None:
+                        yield None
+                        continue
+                    ax, ys, ops, row_surface = row
+                    block_action.x = ax
+                    for ay, z, op in ops:
+                        if op == OP_DESTROY:
+                            block_action.value = DESTROY_BLOCK
+                            cur.remove_point(ax, ay, z)
+                        else:
+                            block_action.value = BUILD_BLOCK
+                            cur.set_point(ax, ay, z, NON_SURFACE_COLOR)
+                        block_action.y = ay
+                        block_action.z = z
+                        self.broadcast_contained(block_action, save=True)
+                        self.mark_rolled_back(job, ax, ay)
+                        yield 1
+                    job.surface.update(row_surface)
+                    for x, y, z in row_surface:
+                        self.mark_rolled_back(job, x, y)
+                        job.uncolored[x * 512 + y] = 1
+                    for ay in ys:
+                        job.mask[ax * 512 + ay] = 0
+                    yield 0
+                job.surface = sorted(job.surface.items(), key=operator.itemgetter(1))
+                job.colored = 0
+            last_color = None
+            block_action.value = BUILD_BLOCK
+            while job.colored < len(job.surface):
+                pos, color = job.surface[job.colored]
+                x, y, z = pos
+                packets_sent = 0
+                if color != last_color:
+                    set_color.value = make_color(*color)
+                    self.broadcast_contained(set_color, save=True)
+                    packets_sent += 1
+                    last_color = color
+                cur.set_point(x, y, z, color)
+                block_action.x = x
+                block_action.y = y
+                block_action.z = z
+                self.broadcast_contained(block_action, save=True)
+                packets_sent += 1
+                job.colored += 1
+                yield packets_sent
+
+        def diff_rows(self, cur, new,
+                      start_x_a, start_y_a, end_x_a, end_y_a,
+                      start_x_b, start_y_b, end_x_b, end_y_b,
+                      ignore_indestructable, mask, z_range=(0, 64)):
+            """
+            Yield (x, [y], [(y, z, op)], {(x, y, z): color}) for every row of the range, comparing voxel by voxel
+            the columns set in mask between z_range
+            """
+            if isinstance(new, Snapshot):
+                new = VXLData(io.BytesIO(new.generate()))
             check_protected = hasattr(protocol, 'protected')
             range_x = range(end_x_a - start_x_a)
-            range_y = range(end_y_a - start_y_a)
+            # rows are diffed one ahead of the row being applied to cur, so its surfaces are still the old ones
+            pending = None
             for x in range_x:
                 ax = start_x_a + x
                 bx = start_x_b + x
-                block_action.x = ax
-                for y in range_y:
+                ops = []
+                surface = {}
+                ys = [y - start_y_a for y in masked_ys(mask, ax, start_y_a, end_y_a)]
+                for y in ys:
                     ay = start_y_a + y
                     by = start_y_b + y
-                    block_action.y = ay
                     if check_protected and self.is_protected(ax, ay, 0):
                         continue
-                    for z in range(64):
-                        action = None
+                    for z in range(*z_range):
                         cur_solid = cur.get_solid(ax, ay, z)
                         new_solid = new.get_solid(bx, by, z)
                         if cur_solid and not new_solid:
                             if (not ignore_indestructable and
                                     self.is_indestructable(ax, ay, z)):
                                 continue
-                            else:
-                                action = DESTROY_BLOCK
-                                cur.remove_point(ax, ay, z)
+                            ops.append((ay, z, OP_DESTROY))
                         elif new_solid:
                             new_is_surface = new.is_surface(bx, by, z)
                             if new_is_surface:
@@ -233,48 +1305,131 @@ def apply_script(protocol, connection, config):
                             if not cur_solid and new_is_surface:
                                 surface[(ax, ay, z)] = new_color
                             elif not cur_solid and not new_is_surface:
-                                action = BUILD_BLOCK
-                                cur.set_point(ax, ay, z, NON_SURFACE_COLOR)
+                                ops.append((ay, z, OP_BUILD))
                             elif cur_solid and new_is_surface:
-                                old_is_surface = old.is_surface(ax, ay, z)
+                                old_is_surface = cur.is_surface(ax, ay, z)
                                 if old_is_surface:
-                                    old_color = old.get_color(ax, ay, z)
+                                    old_color = cur.get_color(ax, ay, z)
                                 if not old_is_surface or old_color != new_color:
                                     surface[(ax, ay, z)] = new_color
-                                    action = DESTROY_BLOCK
-                                    cur.remove_point(ax, ay, z)
-                        if action is not None:
-                            block_action.z = z
-                            block_action.value = action
-                            self.broadcast_contained(block_action, save=True)
-                            yield 1
-                yield 0
-            last_color = None
-            block_action.value = BUILD_BLOCK
-            for pos, color in sorted(iter(surface.items()),
-                                     key=operator.itemgetter(1)):
-                x, y, z = pos
-                packets_sent = 0
-                if color != last_color:
-                    set_color.value = make_color(*color)
-                    self.broadcast_contained(set_color, save=True)
-                    packets_sent += 1
-                    last_color = color
-                cur.set_point(x, y, z, color)
-                block_action.x = x
-                block_action.y = y
-                block_action.z = z
-                self.broadcast_contained(block_action, save=True)
-                packets_sent += 1
-                yield packets_sent
+                                    ops.append((ay, z, OP_DESTROY))
+                if pending is not None:
+                    yield pending
+                pending = ax, [start_y_a + y for y in ys], ops, surface
+            if pending is not None:
+                yield pending
+
+        def diff_rows_numpy(self, cur, new,
+                            start_x_a, start_y_a, end_x_a, end_y_a,
+                            start_x_b, start_y_b, end_x_b, end_y_b,
+                            ignore_indestructable, mask, z_range=(0, 64)):
+            """
+            Same as diff_rows, but decodes whole rows of both maps from their serialized
+            VXL data into arrays and compares them in bulk
+            """
+            (cur_data, cur_offsets), (new_data, new_offsets) = yield from self.serialized_maps(cur, new)
+            for x in range(end_x_a - start_x_a):
+                ax = start_x_a + x
+                bx = start_x_b + x
+                ys = masked_ys(mask, ax, start_y_a, end_y_a)
+                if not ys:
+                    yield ax, ys, [], {}
+                    continue
+                ops, surface = diff_columns(cur_data, [cur_offsets[y * 512 + ax] for y in ys],
+                                            new_data, [new_offsets[(y - start_y_a + start_y_b) * 512 + bx] for y in ys],
+                                            z_range)
+                yield self.filter_diff_row(ax, ys, ops, surface, ignore_indestructable)
+
+        def diff_rows_parallel(self, cur, new,
+                               start_x_a, start_y_a, end_x_a, end_y_a,
+                               start_x_b, start_y_b, end_x_b, end_y_b,
+                               ignore_indestructable, mask, z_range=(0, 64)):
+            """
+            Same as diff_rows_numpy, but every sector is diffed in the process pool and its rows are yielded
+            as soon as it finishes, with None in between while nothing is ready.
+            Yields one row per sector and x
+            """
+            (cur_data, cur_offsets), (new_data, new_offsets) = yield from self.serialized_maps(cur, new)
+            pool = get_diff_pool()
+            pending = []
+            unchanged = []
+            for sector_y in range(start_y_a, end_y_a, 64):
+                sector_end_y = min(sector_y + 64, end_y_a)
+                for sector_x in range(start_x_a, end_x_a, 64):
+                    rows = []
+                    for ax in range(sector_x, min(sector_x + 64, end_x_a)):
+                        ys = masked_ys(mask, ax, sector_y, sector_end_y)
+                        if ys:
+                            rows.append((ax, ys))
+                        else:
+                            unchanged.append(ax)
+                    if not rows:
+                        continue
+                    cur_sector, cur_starts = slice_columns(cur_data, cur_offsets,
+                        [[y * 512 + ax for y in ys] for ax, ys in rows])
+                    new_sector, new_starts = slice_columns(new_data, new_offsets,
+                        [[(y - start_y_a + start_y_b) * 512 + ax - start_x_a + start_x_b for y in ys] for ax, ys in rows])
+                    future = pool.submit(diff_sector, cur_sector, new_sector,
+                                         [(ax, a, b) for (ax, ys), a, b in zip(rows, cur_starts, new_starts)], z_range)
+                    pending.append((future, dict(rows)))
+            for ax in unchanged:
+                yield ax, [], [], {}
+            while pending:
+                done = [item for item in pending if item[0].done()]
+                if not done:
+                    yield None
+                    continue
+                for item in done:
+                    pending.remove(item)
+                    future, rows = item
+                    for ax, ops, surface in future.result():
+                        yield self.filter_diff_row(ax, rows[ax], ops, surface, ignore_indestructable)
+
+        def filter_diff_row(self, ax, ys, ops, surface, ignore_indestructable):
+            """
+            Turn diff_columns output for columns ys of row ax into diff_rows output, leaving out protected columns
+            and indestructable blocks
+            """
+            check_protected = hasattr(protocol, 'protected')
+            protected = set()
+            if check_protected:
+                changed = {k for k, z, op in ops} | {k for k, z, c in surface}
+                protected = {k for k in changed if self.is_protected(ax, ys[k], 0)}
+            surface = {(ax, ys[k], z): ((c >> 16) & 255, (c >> 8) & 255, c & 255)
+                       for k, z, c in surface if k not in protected}
+            row_ops = []
+            for k, z, op in ops:
+                if k in protected:
+                    continue
+                ay = ys[k]
+                if (op == OP_DESTROY and not ignore_indestructable and (ax, ay, z) not in surface and
+                        self.is_indestructable(ax, ay, z)):
+                    continue
+                row_ops.append((ay, z, op))
+            return ax, ys, row_ops, surface
 
         def on_map_change(self, map):
-            self.rollback_map = map.copy()
+            self.map_load = os.urandom(8).hex()
+            self.serialized_map = None
+            self.dirty_columns = bytearray(512 * 512)
+            self.dirty_complete = True
+            self.snapshots = OrderedDict()
+            self.changed_sectors = bytearray(64)
+            self.take_snapshot(ORIGINAL_SNAPSHOT)
+            if self.snapshot_call is None and snapshot_interval:
+                self.snapshot_call = LoopingCall(self.take_periodic_snapshot)
+                self.snapshot_call.start(snapshot_interval * 60, now=False)
+            if resume_on_load and os.path.exists(checkpoint_path):
+                reactor.callLater(0, self.resume_rollback, None)
             protocol.on_map_change(self, map)
 
         def on_map_leave(self):
+            if self.rollback_scan_call is not None:
+                self.rollback_scan_call.stop()
+                self.rollback_scan_call = None
+            self.reload_positions.clear()
             if self.rollback_in_progress:
-                self.end_rollback(S_MAP_CHANGED)
+                self.end_rollback('%s. %s' % (S_MAP_CHANGED, S_CHECKPOINT_SAVED), keep_checkpoint=True)
             protocol.on_map_leave(self)
 
         def on_game_end(self):
@@ -57,6 +57,8 @@ def sculpt(connection, player=None):
 
 def build_block(protocol, player, x, y, z):
     protocol.map.set_point(x, y, z, player.color)
+    if hasattr(protocol, 'mark_dirty'): # rollback.py
+        protocol.mark_dirty(x, y)
     block_action = BlockAction()
     block_action.x = x
     block_action.y = y
@@ -117,7 +119,8 @@ def sculpt_ray(player):
                 # sculpt allows destroying base blocks, but the API doesn't
                 # like this. work around it and force destruction
                 map.remove_point(x, y, z)
-                map.check_node(x, y, z, True)
+                if map.check_node(x, y, z, True) and hasattr(player.protocol, 'mark_collapse'): # rollback.py
+                    player.protocol.mark_collapse()
             player.on_block_removed(x, y, z)
 
 
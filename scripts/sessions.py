@@ -5,7 +5,7 @@ Log connections to assist in detecting ban circumvention and impersonation attem
 """
 
 from datetime import datetime
-from collections import Counter
+from collections import Counter, OrderedDict
 import os, sqlite3
 from piqueserver.commands import command, get_player
 from piqueserver.config import config
@@ -17,6 +17,7 @@ cur.execute('CREATE TABLE IF NOT EXISTS sessions(id INTEGER PRIMARY KEY, dt, use
 con.commit()
 cur.close()
 
+SESSION_CACHE_SIZE = 4096
 
 @command()
 def seen(connection, *player):
@@ -185,6 +186,38 @@ def apply_script(protocol, connection, config):
             self.session = cur.lastrowid
             con.commit()
             cur.close()
+            self.protocol.cache_session_user(self.session, self.name)
             connection.on_login(self, name)
 
-    return protocol, SessionsConnection
+    class SessionsProtocol(protocol):
+
+        def __init__(self, *arg, **kw):
+            protocol.__init__(self, *arg, **kw)
+            self.session_users = OrderedDict()
+
+        def cache_session_user(self, session_id, user):
+            self.session_users[session_id] = user
+            self.session_users.move_to_end(session_id)
+            while len(self.session_users) > SESSION_CACHE_SIZE:
+                self.session_users.popitem(last=False)
+
+        def get_session_users(self, session_ids):
+            """
+            Map session IDs to user names, querying only IDs that aren't cached
+            """
+            # The result is built as IDs are found, since caching a large batch can evict IDs of the same batch
+            users = {}
+            for session_id in session_ids:
+                if session_id in self.session_users:
+                    self.session_users.move_to_end(session_id)
+                    users[session_id] = self.session_users[session_id]
+            missing = list(set(x for x in session_ids if x not in users))
+            if missing:
+                cur = con.cursor()
+                for session_id, user in cur.execute('SELECT id, user FROM sessions WHERE id IN (%s)' % ','.join('?'*len(missing)), missing).fetchall():
+                    users[session_id] = user
+                    self.cache_session_user(session_id, user)
+                cur.close()
+            return {x: users.get(x) for x in session_ids}
+
+    return SessionsProtocol, SessionsConnection
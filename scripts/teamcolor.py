@@ -6,12 +6,13 @@ Commands
 
 * ``/teamcolordisco <interval> [#aabbcc #abc ...]`` - colors are random unless specified
 
+Requires fogtween.py
+
 .. codeauthor:: Liza
 """
 
 import enet
 from random import choices
-from twisted.internet.task import LoopingCall
 from piqueserver.commands import command
 from pyspades import contained as loaders
 from pyspades.color import interpolate_rgb
@@ -133,25 +134,27 @@ def apply_script(protocol, connection, config):
                 generated_data = state_data.generate()
                 packet = enet.Packet(bytes(generated_data), enet.PACKET_FLAG_RELIABLE)
                 player.peer.send(0, packet)
+                # State data resets the client's fog to the protocol color
+                player.sent_fog_color = None
 
-        def __init__(self, *arg, **kw):
-            protocol.__init__(self, *arg, **kw)
-            self.team_loop = LoopingCall(self.update_team_color)
+        def team_cycle(self):
+            while True:
+                self.update_team_color()
+                yield
 
         def update_team_color(self):
             if self.is_team_random:
                 if self.team_n % self.team_interval == 0:
                     self.team_colors = [self.team_colors[-1], choices(range(256), k=3)]
                 clr = interpolate_rgb(self.team_colors[0], self.team_colors[1], self.team_n % self.team_interval / self.team_interval)
-                self.send_teamdata(team1_color = clr)
-                self.send_teamdata(team2_color = (255 - clr[0], 255 - clr[1], 255 - clr[2]))
             else:
                 color_a = self.team_n % (len(self.team_colors) * self.team_interval) // self.team_interval
                 color_b = (self.team_n + self.team_interval) % (len(self.team_colors) * self.team_interval) // self.team_interval
                 clr = interpolate_rgb(self.team_colors[color_a], self.team_colors[color_b], self.team_n % self.team_interval / self.team_interval)
-                self.send_teamdata(team1_color = clr)
-                self.send_teamdata(team2_color = (255 - clr[0], 255 - clr[1], 255 - clr[2]))
             self.team_n += 1
+            # Both teams go out in one state data packet, and only when the color actually moved
+            if tuple(clr) != tuple(self.team1_color):
+                self.send_teamdata(team1_color = clr, team2_color = (255 - clr[0], 255 - clr[1], 255 - clr[2]))
 
         def start_team_cycle(self, interval, colors=[], is_random=False):
             if self.is_team_active:
@@ -165,11 +168,11 @@ def apply_script(protocol, connection, config):
                 choices(range(256), k=3),
                 choices(range(256), k=3)
                 ]
-            self.team_loop.start(0.2)
+            self.start_tween('teamcolor', self.team_cycle(), 0.2)
 
         def stop_team_cycle(self):
             if self.is_team_active:
-                self.team_loop.stop()
+                self.stop_tween('teamcolor')
                 self.is_team_active = False
                 self.send_teamdata(team1_color = self.original_team_colors[0])
                 self.send_teamdata(team2_color = self.original_team_colors[1])
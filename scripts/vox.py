@@ -43,6 +43,8 @@ def build(con, x, y, z, rgb, dither, rgbshift):
     block_action.z = z
     con.protocol.broadcast_contained(block_action)
     con.protocol.map.set_point(x, y, z, rgb)
+    if hasattr(con.protocol, 'mark_dirty'): # rollback.py
+        con.protocol.mark_dirty(x, y)
 
 @command(admin_only=True)
 def loadvox(con, fn=None, dither=0, rotate='', shift=1, pattern='', px=None, py=None, pz=None):